@@ -25,6 +25,10 @@ import time
 import os
 import re
 import logging
+import threading
+import contextlib
+import collections
+import uuid
 from websocket import create_connection # not websockets; websocket (singular) allows simple synchronous send
 
 # use one table for teams, one table for assignments, and reduce duplication of data;
@@ -80,13 +84,44 @@ HISTORY_COLS=[
     ["RecordedBy","TEXT"],
     ["Epoch","INTEGER"]]
 
+# secondary indexes: [index name, table, columns, unique, partial-index condition]
+# every getter filters on these columns, so without them each lookup is a full
+#  table scan.  The unique indexes on tid/aid/pid/hid only cover positive IDs,
+#  since a client can hold several not-yet-finalized (-1) rows at the same time;
+#  sqlite won't use those partial indexes for 'tid=5' lookups, so each ID also
+#  gets a plain index
+TABLE_INDEXES=[
+    ["Teams_tid","Teams","tid",False,None],
+    ["Teams_tid_unique","Teams","tid",True,"tid > 0"],
+    ["Teams_TeamName","Teams","TeamName",True,None],
+    ["Teams_LastEditEpoch","Teams","LastEditEpoch",False,None],
+    ["Assignments_aid","Assignments","aid",False,None],
+    ["Assignments_aid_unique","Assignments","aid",True,"aid > 0"],
+    ["Assignments_AssignmentName","Assignments","AssignmentName",True,None],
+    ["Assignments_LastEditEpoch","Assignments","LastEditEpoch",False,None],
+    ["Pairings_pid","Pairings","pid",False,None],
+    ["Pairings_pid_unique","Pairings","pid",True,"pid > 0"],
+    ["Pairings_aid_tid_PairingStatus","Pairings","aid,tid,PairingStatus",False,None],
+    ["Pairings_tid_PairingStatus","Pairings","tid,PairingStatus",False,None],
+    ["Pairings_LastEditEpoch","Pairings","LastEditEpoch",False,None],
+    ["History_hid","History","hid",False,None],
+    ["History_hid_unique","History","hid",True,"hid > 0"],
+    ["History_aid_tid_Epoch","History","aid,tid,Epoch",False,None],
+    ["History_tid_Epoch","History","tid,Epoch",False,None],
+    ["History_Epoch","History","Epoch",False,None],
+    ["History_aid","History","aid",False,None], # (aid,n): newest-first pages for an assignment
+    ["History_tid","History","tid",False,None],
+    ["ChangeLog_TableName_seq","ChangeLog","TableName,seq",False,None],
+    ["HistoryArchive_aid","HistoryArchive","aid",False,None],
+    ["HistoryArchive_tid","HistoryArchive","tid",False,None],
+    ["HistoryArchive_Epoch","HistoryArchive","Epoch",False,None]]
+
+SCHEMA_VERSION=5 # stored in PRAGMA user_version; increment when TABLE_INDEXES changes
+
 TEAM_STATUSES=["UNASSIGNED","ASSIGNED","WORKING","ENROUTE TO IC","DEBRIEFING"]
 
 host=False # is this running on a web server host?
-nextAid=1 # only used if this is the host
-nextTid=1 # only used if this is the host
-nextPid=1 # only used if this is the host
-nextHid=1 # only used if this is the host
+# the host's next tid/aid/pid/hid values are kept in the Meta table (see nextHostID)
 
 # websockets default values
 url=""
@@ -126,11 +161,76 @@ def dict_factory(cursor, row):
 # each machine running this code will have its own local database file tracker.db;
 #  they are kept separate by the fact that only one separate instance of this code
 #  is running on each machine involved (one on each server, one on each client)
+DB_FILE='tracker.db'
+
+# connection settings: each thread keeps one long-lived connection, configured
+#  once when it is opened, rather than opening and closing a connection for
+#  every query; WAL lets readers (sync and view requests) proceed while another
+#  thread is writing, and synchronous=NORMAL is durable across application crashes
+#  (only an OS crash / power loss can lose the most recent transactions)
+DB_STATEMENT_CACHE=256 # number of compiled statements kept per connection
+DB_PRAGMAS=[
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8000", # negative = KiB, i.e. 8MB page cache per connection
+    "PRAGMA mmap_size=67108864", # 64MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY"]
+dbJournalMode='WAL'
+if not wsUseURL: # pythonanywhere: WAL needs shared memory, which network file systems do not provide
+    dbJournalMode='TRUNCATE'
+
+_connLocal=threading.local() # per-thread connection
+_connLock=threading.Lock()
+_conns=[] # [thread,connection] for every open connection, so they can be closed before the file is removed
+_connGeneration=0 # incremented by tdbCloseConnections; stale per-thread connections are reopened
+connStats={'connects':0,'queries':0}
+
+def getConn():
+    conn=getattr(_connLocal,'conn',None)
+    if conn is None or _connLocal.generation!=_connGeneration:
+        # check_same_thread=False only so that tdbCloseConnections can close
+        #  connections owned by other threads; each connection is otherwise only
+        #  used by the thread that opened it
+        conn=sqlite3.connect(DB_FILE,cached_statements=DB_STATEMENT_CACHE,check_same_thread=False)
+        conn.row_factory = dict_factory # so that return value is a dict instead of tuples
+        conn.execute("PRAGMA journal_mode="+dbJournalMode)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        with _connLock:
+            # threaded web servers may use a new thread per request; close the
+            #  connections left behind by threads that have since exited
+            for [thread,c] in [x for x in _conns if not x[0].is_alive()]:
+                c.close()
+                _conns.remove([thread,c])
+            _conns.append([threading.current_thread(),conn])
+            connStats['connects']+=1
+        _connLocal.conn=conn
+        _connLocal.generation=_connGeneration
+    return conn
+
+def tdbCloseConnections():
+    global _connGeneration
+    with _connLock:
+        for [thread,conn] in _conns:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.warning("could not close database connection: "+str(e))
+        _conns.clear()
+        _connGeneration+=1
+
+# tdbGetConnStats - number of connections opened, number of queries, and the
+#  number of connects that were saved by reusing the per-thread connections
+def tdbGetConnStats():
+    d=dict(connStats)
+    d['connectsSaved']=max(0,d['queries']-d['connects'])
+    d['openConnections']=len(_conns)
+    return d
+
 def q(query,params=None):
     # logging.info("q called logger: "+query)
-    conn = sqlite3.connect('tracker.db')
-    conn.row_factory = dict_factory # so that return value is a dict instead of tuples
+    conn=getConn()
     cur = conn.cursor()
+    connStats['queries']+=1
     # fetchall if params is blank seems to only return a tuple, not a dict
     
     try:
@@ -138,11 +238,18 @@ def q(query,params=None):
             r=cur.execute(query,params).fetchall()
         else:
             r=cur.execute(query).fetchall()
-        conn.commit()
+        if conn.in_transaction and not inBatch(): # tdbBatch commits at the end of the batch
+            conn.commit()
     except:
         logging.warning("ERROR during SQL query:")
         logging.warning("  query='"+str(query)+"'")
         logging.warning("  params='"+str(params)+"'")
+        # inside a batch, raise the error, so that tdbBatch rolls back the
+        #  whole batch rather than committing the statements around this one
+        if inBatch():
+            raise
+        if conn.in_transaction:
+            conn.rollback()
         return None
     # for update requests, return the number of rows affected
     if query.lower().startswith('update'):
@@ -150,34 +257,269 @@ def q(query,params=None):
     # logging.info("  result:" +str(r))
     return r
 
-def wsCheck(url):
-    if wsUseURL:
+# qMany - run one statement for each set of params in paramsList (executemany);
+#  returns the total number of rows affected, or None on error (raises inside
+#  a batch, like q)
+def qMany(query,paramsList):
+    conn=getConn()
+    cur = conn.cursor()
+    connStats['queries']+=1
+    try:
+        cur.executemany(query,paramsList)
+        if conn.in_transaction and not inBatch():
+            conn.commit()
+    except:
+        logging.warning("ERROR during SQL executemany:")
+        logging.warning("  query='"+str(query)+"'")
+        if inBatch():
+            raise
+        if conn.in_transaction:
+            conn.rollback()
+        return None
+    return cur.rowcount
+
+# tdbBatch - run several tdb* calls as one unit:
+#    with tdbBatch():
+#        tdbSetPairingStatusByID(pid,'PREVIOUS')
+#        tdbSetTeamStatusByID(tid,'UNASSIGNED')
+#  all statements run in one sqlite transaction (one commit / fsync instead
+#  of one per statement), other threads do not see the board model in an
+#  intermediate state, and tdbPushTables calls made during the batch are held
+#  back and replaced by a single push once the batch has been committed, so
+#  that viewers don't flicker through the intermediate states; likewise for
+#  the change notification to clients (tdbNotifyChanges).  If the body
+#  raises an exception, the whole batch is rolled back and nothing is pushed.
+#  Inside a batch, a statement that fails raises its sqlite3.Error instead of
+#  q returning None, so a batch is never committed half applied; callers
+#  that can recover catch sqlite3.Error outside the batch.
+#  Batches can be nested; only the outermost one commits and pushes.
+# tdbBatch(write=False) is for several reads that must see the same state of
+#  the database; it does not take the write lock or the board model lock.
+def inBatch():
+    return getattr(_connLocal,'batchDepth',0)>0
+
+@contextlib.contextmanager
+def tdbBatch(write=True):
+    if inBatch():
+        _connLocal.batchDepth+=1
+        try:
+            yield
+        finally:
+            _connLocal.batchDepth-=1
+        return
+    with board.lock if write else contextlib.nullcontext():
+        conn=getConn()
+        if conn.in_transaction:
+            conn.commit()
+        # IMMEDIATE: take the write lock now, rather than failing part way
+        #  through the batch if another connection is writing
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        _connLocal.batchDepth=1
+        _connLocal.pushPending=False
+        _connLocal.changesPending=False
+        if write:
+            # no other connection can write until the batch ends, so the
+            #  model only needs to be checked once, here
+            board.ensureCurrent()
+            board.currentInBatch=True
         try:
-            ws=create_connection(url,1) # 1 second timeout
+            yield
         except:
-            return False
+            conn.rollback()
+            if write:
+                board.load() # the model may contain rows that were just rolled back
+            raise
         else:
-            ws.close()
+            conn.commit()
+        finally:
+            _connLocal.batchDepth=0
+            if write:
+                board.currentInBatch=False
+    if _connLocal.pushPending:
+        _connLocal.pushPending=False
+        tdbPushTables()
+    if _connLocal.changesPending:
+        _connLocal.changesPending=False
+        tdbNotifyChanges()
+
+#####################################
+## WEBSOCKET SENDER
+#####################################
+## messages are not sent by the thread that calls wsSend (i.e. inside the
+##   http request that made the change); wsSend puts them in a bounded queue,
+##   and a background sender thread sends them over one long-lived connection
+##   to the websockets repeater, reconnecting with backoff if the connection
+##   is lost.  On pythonanywhere the sender thread makes the pusher.com calls.
+## when the queue backs up, a new snapshot (or legacy full message) replaces
+##   any queued board messages that it supersedes, so only the newest full
+##   board is sent.  If the queue is still full, the oldest message is
+##   dropped; viewers will see the sequence gap and ask for a snapshot.
+## the repeater sends every message to every listener, including this one;
+##   a receiver thread reads them, so that the repeater is never blocked by
+##   an unread connection, and answers 'snapshotRequest' messages from viewers.
+
+WS_QUEUE_SIZE=100
+WS_CONNECT_TIMEOUT=1 # seconds
+WS_BACKOFF_MIN=0.5 # seconds; doubled after each failed connection attempt
+WS_BACKOFF_MAX=30
+
+class WsSender():
+    def __init__(self,url=None): # url=None: use pusher.com
+        self.url=url
+        self.cond=threading.Condition()
+        self.queue=collections.deque() # [msg,kind,time queued]
+        self.ws=None
+        self.lost=False # set by the receiver thread when the connection drops
+        self.connected=threading.Event()
+        self.stats={
+            'sent':0,
+            'sendFailures':0,
+            'dropped':0,
+            'conflated':0,
+            'connects':0,
+            'reconnects':0,
+            'connectFailures':0,
+            'latencyTotal':0.0, # seconds from wsSend to sent, summed over all sent messages
+            'latencyMax':0.0}
+        self.thread=threading.Thread(target=self.run,name='wsSender',daemon=True)
+        self.thread.start()
+
+    # kind: 'snapshot', 'full', 'delta', 'changes', or None; a 'snapshot' supersedes
+    #  queued snapshots and deltas, a 'full' message supersedes queued full messages,
+    #  and a 'changes' notification supersedes queued notifications
+    def put(self,msg,kind=None):
+        superseded={'snapshot':['snapshot','delta'],'full':['full'],'changes':['changes']}.get(kind)
+        with self.cond:
+            if superseded:
+                kept=[x for x in self.queue if x[1] not in superseded]
+                self.stats['conflated']+=len(self.queue)-len(kept)
+                self.queue=collections.deque(kept)
+            if len(self.queue)>=WS_QUEUE_SIZE:
+                self.queue.popleft()
+                self.stats['dropped']+=1
+            self.queue.append([msg,kind,time.time()])
+            self.cond.notify()
+
+    def connect(self):
+        self.ws=create_connection(self.url,WS_CONNECT_TIMEOUT)
+        self.ws.settimeout(None) # the receiver thread waits indefinitely for messages
+        self.stats['connects']+=1
+        if self.stats['connects']>1:
+            self.stats['reconnects']+=1
+        self.connected.set()
+        logging.info("websocket connected to "+self.url)
+        threading.Thread(target=self.receive,args=(self.ws,),name='wsReceiver',daemon=True).start()
+
+    def disconnect(self):
+        self.connected.clear()
+        if self.ws:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+        self.ws=None
+
+    def run(self):
+        backoff=WS_BACKOFF_MIN
+        while True:
+            if self.url and not self.ws: # connect right away, not only when there is something to send
+                try:
+                    self.connect()
+                    backoff=WS_BACKOFF_MIN
+                except Exception as e:
+                    self.stats['connectFailures']+=1
+                    logging.info("websocket connection to "+self.url+" failed; retrying in "+str(backoff)+" seconds: "+str(e))
+                    time.sleep(backoff)
+                    backoff=min(backoff*2,WS_BACKOFF_MAX)
+                    continue
+            with self.cond:
+                while not self.queue and not self.lost:
+                    self.cond.wait()
+                lost=self.lost
+                self.lost=False
+                if not lost:
+                    item=self.queue[0] # leave it in the queue until it has been sent
+            if lost:
+                self.disconnect()
+                continue
+            try:
+                if self.url:
+                    self.ws.send(json.dumps({'msg':item[0]}))
+                else:
+                    pusher_client.trigger('my-channel', 'my-event', {'msg': item[0]})
+            except Exception as e:
+                self.stats['sendFailures']+=1
+                logging.info("websocket send failed: "+str(e))
+                if self.url: # the message stays in the queue; reconnect and send it again
+                    self.disconnect()
+                    continue
+                # pusher: don't retry; viewers will recover from the next snapshot
+            else:
+                latency=time.time()-item[2]
+                self.stats['sent']+=1
+                self.stats['latencyTotal']+=latency
+                self.stats['latencyMax']=max(self.stats['latencyMax'],latency)
+            with self.cond:
+                if self.queue and self.queue[0] is item: # it may have been conflated while being sent
+                    self.queue.popleft()
+
+    def receive(self,ws):
+        while True:
+            try:
+                message=ws.recv()
+            except Exception:
+                with self.cond: # connection lost while idle: tell the sender to reconnect
+                    if ws is self.ws:
+                        self.lost=True
+                        self.cond.notify()
+                return
+            try:
+                msg=json.loads(json.loads(message)['msg'])
+            except Exception:
+                continue
+            if isinstance(msg,dict) and msg.get('type')=='snapshotRequest':
+                # several viewers may ask at once; one snapshot answers them all
+                if time.time()-pushState['lastSnapshotTime']>1:
+                    tdbRequestSnapshot()
+
+    # waitConnected - wait up to timeout seconds for the connection; True if connected
+    def waitConnected(self,timeout):
+        if not self.url:
             return True
-    else:
-        return True
+        return self.connected.wait(timeout)
+
+    def getStats(self):
+        with self.cond:
+            d=dict(self.stats)
+            d['queueDepth']=len(self.queue)
+        d['connected']=self.connected.is_set()
+        d['latencyAvg']=d['latencyTotal']/d['sent'] if d['sent'] else 0.0
+        return d
+
+_wsSenders={} # url (or None for pusher.com) : WsSender
+_wsSendersLock=threading.Lock()
+
+def getWsSender(wsUrl):
+    if not wsUseURL:
+        wsUrl=None
+    with _wsSendersLock:
+        if wsUrl not in _wsSenders:
+            _wsSenders[wsUrl]=WsSender(wsUrl)
+        return _wsSenders[wsUrl]
+
+def wsCheck(url):
+    return getWsSender(url).waitConnected(WS_CONNECT_TIMEOUT)
 
-def wsSend(msg,wsUrl=None):
+# wsSend - queue msg for sending; returns immediately
+def wsSend(msg,wsUrl=None,kind=None):
     wsUrl=wsUrl or url # use the global url normally
-    # logging.info("sending - wsUseURL="+str(wsUseURL))
-    if wsUseURL:
-        try:
-            ws=create_connection(wsUrl,1) # 1 second timeout
-            ws.send(json.dumps({'msg':msg}))
-            ws.close()
-            logging.info("websocket send to "+wsUrl+" successful")
-        except:
-            logging.info("websocket send to "+wsUrl+" failed")
-    else: # use pusher.com
-        try:
-            pusher_client.trigger('my-channel', 'my-event', {'msg': msg})
-        except Exception as e:
-            logging.info("pusher send failed: "+str(e))
+    getWsSender(wsUrl).put(msg,kind)
+
+# tdbGetWsStats - queue depth, send latency, and connection counts for each sender
+def tdbGetWsStats():
+    with _wsSendersLock:
+        senders=list(_wsSenders.items())
+    return {str(wsUrl or 'pusher'):sender.getStats() for (wsUrl,sender) in senders}
 
 def createTeamsTableIfNeeded():
     colString="'n' INTEGER PRIMARY KEY AUTOINCREMENT,"
@@ -203,31 +545,122 @@ def createHistoryTableIfNeeded():
     query='CREATE TABLE IF NOT EXISTS "History" ('+colString+');'
     return q(query)
 
-# tdbInit will only be called once, when the first node joins
-def tdbInit(server=None):
-    logging.info('tdbInit called: server='+str(server))
-    if os.path.exists('tracker.db'):
-        os.remove('tracker.db')
+# archived history keeps the n it had in the History table (History n values
+#  are never reused, since n is AUTOINCREMENT), so that entries from both
+#  tables can be merged in order
+def createHistoryArchiveTablesIfNeeded():
+    colString="'n' INTEGER PRIMARY KEY,"
+    colString+=', '.join([str(x[0])+" "+str(x[1]) for x in HISTORY_COLS])
+    q('CREATE TABLE IF NOT EXISTS "HistoryArchive" ('+colString+');')
+    q('CREATE TABLE IF NOT EXISTS "HistorySummary" ("aid" INTEGER, "tid" INTEGER, "Entries" INTEGER, "FirstEpoch" INTEGER, "LastEpoch" INTEGER, PRIMARY KEY("aid","tid"));')
+
+# create any missing indexes; safe to call on an existing database.  If
+#  existing rows violate a unique index (e.g. a database written by an older
+#  version), a plain index is created instead so that lookups are still fast
+def createIndexesIfNeeded():
+    for [name,table,columns,unique,condition] in TABLE_INDEXES:
+        query='CREATE {unique}INDEX IF NOT EXISTS "{name}" ON "{table}" ({columns}){where};'
+        where=' WHERE '+condition if condition else ''
+        r=q(query.format(unique='UNIQUE ' if unique else '',name=name,table=table,columns=columns,where=where))
+        if r is None and unique:
+            logging.error("could not create unique index "+name+" (duplicate values?); creating a non-unique index instead; sync will use the slower UPDATE / INSERT path")
+            q(query.format(unique='',name=name,table=table,columns=columns,where=where))
+
+# tdbUpgradeSchema - bring the tables and indexes of an existing database up
+#  to date; called by tdbInit, and can be called on a database from a previous version
+def tdbUpgradeSchema():
     createTeamsTableIfNeeded()
     createAssignmentsTableIfNeeded()
     createPairingsTableIfNeeded()
     createHistoryTableIfNeeded()
+    createHistoryArchiveTablesIfNeeded()
+    createHistorySearchTableIfNeeded()
+    createMetaTableIfNeeded()
+    createChangeLogTableIfNeeded()
+    r=q('PRAGMA user_version;')
+    version=r[0]['user_version'] if r else 0
+    if version<SCHEMA_VERSION:
+        logging.info('upgrading database schema from version '+str(version)+' to '+str(SCHEMA_VERSION))
+        createIndexesIfNeeded()
+        q('PRAGMA user_version='+str(SCHEMA_VERSION)+';')
+    checkSyncUpserts()
+
+# tdbExplainQueryPlans - run EXPLAIN QUERY PLAN on the queries used by the tdbGet*
+#  functions and the 'since' sync queries; returns a dictionary of
+#  query description : list of plan steps, and logs a warning for any query
+#  that still does a full table scan
+EXPLAIN_QUERIES=[
+    ["team ID by name","SELECT tid FROM 'Teams' WHERE TeamName='101';"],
+    ["team name by ID","SELECT TeamName FROM 'Teams' WHERE tid='1';"],
+    ["assignment ID by name","SELECT aid FROM 'Assignments' WHERE AssignmentName='AA';"],
+    ["assignment name by ID","SELECT AssignmentName FROM 'Assignments' WHERE aid='1';"],
+    ["pairing by ID","SELECT * FROM 'Pairings' WHERE pid=1;"],
+    ["pairings by team","SELECT * FROM 'Pairings' WHERE tid=1 AND PairingStatus='CURRENT';"],
+    ["pairings by assignment","SELECT * FROM 'Pairings' WHERE aid=1 AND PairingStatus='CURRENT';"],
+    ["pairing ID by names","SELECT pid FROM 'Pairings' WHERE aid=1 AND tid=1 AND PairingStatus='PREVIOUS';"],
+    ["teams since","SELECT * FROM 'Teams' WHERE LastEditEpoch > 1600000000;"],
+    ["assignments since","SELECT * FROM 'Assignments' WHERE LastEditEpoch > 1600000000;"],
+    ["pairings since","SELECT * FROM 'Pairings' WHERE LastEditEpoch > 1600000000;"],
+    ["history since","SELECT * FROM 'History' WHERE Epoch > 1600000000;"],
+    ["teams changed since","SELECT * FROM 'Teams' WHERE n IN (SELECT n FROM 'ChangeLog' WHERE TableName='Teams' AND seq > 100);"],
+    ["history by pairing","SELECT * FROM 'History' WHERE aid=1 AND tid=1;"],
+    ["history by team or assignment","SELECT * FROM 'History' WHERE aid=1 OR tid=1;"],
+    ["history page by assignment","SELECT * FROM 'History' WHERE aid=1 AND n < 100 ORDER BY n DESC LIMIT 50;"],
+    ["history page by team or assignment","SELECT * FROM 'History' WHERE (aid=1 OR tid=1) AND n < 100 ORDER BY n DESC LIMIT 50;"]]
+
+def tdbExplainQueryPlans():
+    plans={}
+    for [name,query] in EXPLAIN_QUERIES:
+        plan=[x['detail'] for x in q('EXPLAIN QUERY PLAN '+query) or []]
+        plans[name]=plan
+        if any(step.startswith('SCAN') for step in plan):
+            logging.warning('query plan for "'+name+'" includes a full table scan: '+str(plan))
+    return plans
+
+# tdbInit will only be called once, when the first node joins
+def tdbInit(server=None):
+    logging.info('tdbInit called: server='+str(server))
+    tdbCloseConnections() # the file can't be removed while connections are open (on Windows)
+    for f in [DB_FILE,DB_FILE+'-wal',DB_FILE+'-shm']:
+        if os.path.exists(f):
+            os.remove(f)
+    tdbUpgradeSchema()
+    board.load()
     if server:
-        wsUrl='ws://'+re.sub(':.*$','',server)+':80'
-        global wsOk
-        global url
-        global host
-        global nextTid
-        global nextAid
-        global nextPid
-        nextTid=1 # only used if this is the host
-        nextAid=1 # only used if this is the host
-        nextPid=1 # only used if this is the host
-        host=True
-        wsOk=wsCheck(wsUrl)
-        url=wsUrl
-        tdbPushTables()
-        logging.info("wsCheck "+url+" : "+str(wsOk))
+        startHost(server)
+
+# tdbResume - warm restart: reopen the existing incident database instead of
+#  re-creating it, e.g. when the host process restarts in the middle of an
+#  incident.  The ID counters and the change feed are stored in the database,
+#  so new IDs continue where they left off and clients keep syncing from their
+#  last sync point.  Returns False if there is no database to resume, in
+#  which case tdbInit should be called instead.
+def tdbResume(server=None):
+    logging.info('tdbResume called: server='+str(server))
+    if not os.path.exists(DB_FILE):
+        return False
+    t0=time.time()
+    tdbCloseConnections()
+    tdbUpgradeSchema()
+    initHostIDs()
+    board.load()
+    if server:
+        startHost(server)
+    logging.info('resumed incident '+str(tdbGetIncidentID())+' in '+str(round((time.time()-t0)*1000,1))+' ms')
+    return True
+
+def startHost(server):
+    global wsOk
+    global url
+    global host
+    wsUrl='ws://'+re.sub(':.*$','',server)+':80'
+    host=True
+    url=wsUrl
+    # starts the sender, which keeps trying to connect if the repeater is not up yet
+    logging.info("wsCheck "+url+" : "+str(wsCheck(wsUrl)))
+    wsOk=True
+    tdbPushTables()
+    startSnapshotTimer()
 
 # insert using db parameters to avoid SQL injection attack and to correctly handle None
 def qInsert(tableName,d):
@@ -242,6 +675,621 @@ def qInsert(tableName,d):
             valList=valList)
     return q(query,d)
     
+#####################################
+## BOARD MODEL
+#####################################
+## in-memory copy of the Teams, Assignments and Pairings tables, along with
+##   the teams view and assignments view rows built from them.  It is loaded
+##   once, then updated in place by the tdb* mutators, so that building the
+##   views (which happens after every change) only rebuilds the rows that
+##   changed.  SQLite is still the durable store: rows are put into the model
+##   after they are written to the database, by boardRefresh.
+## the model is keyed by the local primary key n, since tid/aid/pid are -1
+##   on clients until the host responds
+## other processes (e.g. several web server workers) may write to the same
+##   database file, so every change also bumps BoardVersion in the Meta table;
+##   if the version in the database is not the one the model expects, the
+##   model reloads itself.  Lookups check the version at most once every
+##   BOARD_LOOKUP_MAX_AGE seconds, since checking costs as much as the lookup.
+
+BOARD_LOOKUP_MAX_AGE=1 # seconds
+
+BOARD_TABLES={ # table name : ID column
+    'Teams':'tid',
+    'Assignments':'aid',
+    'Pairings':'pid'}
+
+def createMetaTableIfNeeded():
+    q('CREATE TABLE IF NOT EXISTS "Meta" ("Key" TEXT PRIMARY KEY, "Value");')
+    q("INSERT OR IGNORE INTO 'Meta' (Key,Value) VALUES ('BoardVersion',0);")
+    # identifies this incident database, so that clients can tell a restarted
+    #  host (same incident) from a re-initialized one (new incident)
+    q("INSERT OR IGNORE INTO 'Meta' (Key,Value) VALUES ('IncidentID',?);",(uuid.uuid4().hex,))
+
+def getBoardVersion():
+    r=q("SELECT Value FROM 'Meta' WHERE Key='BoardVersion';")
+    if r:
+        return r[0]['Value']
+    return None
+
+def bumpBoardVersion():
+    q("UPDATE 'Meta' SET Value=Value+1 WHERE Key='BoardVersion';")
+    return getBoardVersion()
+
+class BoardModel():
+    def __init__(self):
+        self.lock=threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.loaded=False
+        self.version=None
+        self.checkedAt=0 # time.monotonic() when version was last known to match the database
+        self.rows={table:{} for table in BOARD_TABLES} # table : {n : row}
+        self.nByID={table:{} for table in BOARD_TABLES} # table : {id : n}, positive IDs only
+        self.teamNByName={}
+        self.assignmentNByName={}
+        self.pairingNsByTid={} # tid : set of Pairings n
+        self.pairingNsByAid={} # aid : set of Pairings n
+        self.teamRows={} # Teams n : teams view row
+        self.assignmentRows={} # Assignments n : list of assignments view rows (current pairings, or the unpaired row)
+        self.completedRows={} # Assignments n : list of assignments view rows for completed pairings
+        self.dirtyTeams=set()
+        self.dirtyAssignments=set()
+        self.medicalTeams=None # rebuilt after any team changes
+        self.countsCache=None # rebuilt after any change to the model
+        self.currentInBatch=False # set by tdbBatch while it holds the lock and the database write lock
+
+    def load(self):
+        with self.lock:
+            self.clear()
+            self.version=getBoardVersion()
+            for table in BOARD_TABLES:
+                for row in q("SELECT * FROM '"+table+"' ORDER BY n;") or []:
+                    self.put(table,row)
+            self.loaded=True
+            self.checkedAt=time.monotonic()
+
+    # the model is current if it has been loaded and nobody else has changed the database since;
+    #  with maxAge, don't check again if it was checked less than maxAge seconds
+    #  ago.  Returns True if it queried the database.
+    def ensureCurrent(self,maxAge=0):
+        with self.lock:
+            if self.currentInBatch: # checked at the start of the batch that holds the lock
+                return False
+            if self.loaded and time.monotonic()-self.checkedAt<maxAge:
+                return False
+            if not self.loaded or getBoardVersion()!=self.version:
+                if self.loaded:
+                    logging.info('board model is out of date; reloading')
+                self.load()
+            self.checkedAt=time.monotonic()
+            return True
+
+    # mark the view rows that show this row as needing to be rebuilt
+    def touch(self,table,row):
+        self.countsCache=None
+        if table=='Teams':
+            self.dirtyTeams.add(row['n'])
+            self.medicalTeams=None
+            for pn in self.pairingNsByTid.get(row['tid'],()):
+                an=self.nByID['Assignments'].get(self.rows['Pairings'][pn]['aid'])
+                if an is not None:
+                    self.dirtyAssignments.add(an)
+        elif table=='Assignments':
+            self.dirtyAssignments.add(row['n'])
+            for pn in self.pairingNsByAid.get(row['aid'],()):
+                tn=self.nByID['Teams'].get(self.rows['Pairings'][pn]['tid'])
+                if tn is not None:
+                    self.dirtyTeams.add(tn)
+        elif table=='Pairings':
+            tn=self.nByID['Teams'].get(row['tid'])
+            if tn is not None:
+                self.dirtyTeams.add(tn)
+            an=self.nByID['Assignments'].get(row['aid'])
+            if an is not None:
+                self.dirtyAssignments.add(an)
+
+    def put(self,table,row):
+        self.remove(table,row['n'])
+        row=dict(row)
+        n=row['n']
+        self.rows[table][n]=row
+        id=row[BOARD_TABLES[table]]
+        if id is not None and id>0:
+            self.nByID[table][id]=n
+        if table=='Teams':
+            self.teamNByName[row['TeamName']]=n
+        elif table=='Assignments':
+            self.assignmentNByName[row['AssignmentName']]=n
+        elif table=='Pairings':
+            self.pairingNsByTid.setdefault(row['tid'],set()).add(n)
+            self.pairingNsByAid.setdefault(row['aid'],set()).add(n)
+        self.touch(table,row)
+
+    def remove(self,table,n):
+        row=self.rows[table].pop(n,None)
+        if row is None:
+            return
+        self.touch(table,row)
+        id=row[BOARD_TABLES[table]]
+        if self.nByID[table].get(id)==n:
+            del self.nByID[table][id]
+        if table=='Teams':
+            if self.teamNByName.get(row['TeamName'])==n:
+                del self.teamNByName[row['TeamName']]
+            self.teamRows.pop(n,None)
+            self.dirtyTeams.discard(n)
+        elif table=='Assignments':
+            if self.assignmentNByName.get(row['AssignmentName'])==n:
+                del self.assignmentNByName[row['AssignmentName']]
+            self.assignmentRows.pop(n,None)
+            self.completedRows.pop(n,None)
+            self.dirtyAssignments.discard(n)
+        elif table=='Pairings':
+            self.pairingNsByTid.get(row['tid'],set()).discard(n)
+            self.pairingNsByAid.get(row['aid'],set()).discard(n)
+
+    def rebuildDirtyRows(self):
+        teams=self.rows['Teams']
+        assignments=self.rows['Assignments']
+        pairings=self.rows['Pairings']
+        for n in self.dirtyTeams:
+            team=teams[n]
+            currentAssignments=[]
+            previousAssignments=[]
+            for pn in sorted(self.pairingNsByTid.get(team['tid'],())):
+                pairing=pairings[pn]
+                an=self.nByID['Assignments'].get(pairing['aid'])
+                if an is None:
+                    continue
+                if pairing['PairingStatus']=='CURRENT':
+                    currentAssignments.append(assignments[an]['AssignmentName'])
+                elif pairing['PairingStatus']=='PREVIOUS':
+                    previousAssignments.append(assignments[an]['AssignmentName'])
+            self.teamRows[n]=[
+                team['TeamName'],
+                ','.join(currentAssignments) or '--',
+                team['TeamStatus'],
+                team['Resource'],
+                ','.join(previousAssignments) or '--']
+        self.dirtyTeams.clear()
+        for n in self.dirtyAssignments:
+            assignment=assignments[n]
+            assignmentName=assignment['AssignmentName']
+            rows=[]
+            completed=[]
+            pns=sorted(self.pairingNsByAid.get(assignment['aid'],()))
+            if not pns:
+                rows.append([assignmentName,'--',assignment['AssignmentStatus'],assignment['IntendedResource']])
+            for pn in pns:
+                pairing=pairings[pn]
+                if pairing['PairingStatus']=='PREVIOUS':
+                    completed.append([assignmentName,pairing['NameSave'],'COMPLETED',pairing['ResourceSave']])
+                else:
+                    team=teams.get(self.nByID['Teams'].get(pairing['tid']),{})
+                    rows.append([assignmentName,team.get('TeamName'),team.get('TeamStatus'),team.get('Resource')])
+            self.assignmentRows[n]=rows
+            self.completedRows[n]=completed
+        self.dirtyAssignments.clear()
+
+    # the views return copies of the rows, so that callers can't modify the model
+    def teamsView(self):
+        with self.lock:
+            self.ensureCurrent()
+            self.rebuildDirtyRows()
+            return [list(self.teamRows[n]) for n in sorted(self.rows['Teams'])]
+
+    def assignmentsView(self):
+        with self.lock:
+            self.ensureCurrent()
+            self.rebuildDirtyRows()
+            ns=sorted(self.rows['Assignments'])
+            assignmentsList=[list(row) for n in ns for row in self.assignmentRows[n]]
+            assignmentsList+=[list(row) for n in ns for row in self.completedRows[n]]
+            return assignmentsList
+
+    # counts - the same counts as tdbPushTables, without copying the views;
+    #  cached until the next change to the model
+    def counts(self):
+        with self.lock:
+            self.ensureCurrent()
+            if self.countsCache is None:
+                self.rebuildDirtyRows()
+                teamStatuses=[row[2] for row in self.teamRows.values()]
+                assignmentStatuses=[row[2] for rows in self.assignmentRows.values() for row in rows]
+                assignmentStatuses+=[row[2] for rows in self.completedRows.values() for row in rows]
+                unassignedTeams=teamStatuses.count('UNASSIGNED')
+                unassignedAssignments=assignmentStatuses.count('UNASSIGNED')
+                completedAssignments=assignmentStatuses.count('COMPLETED')
+                self.countsCache={
+                    "assignedTeamsCount":len(teamStatuses)-unassignedTeams,
+                    "unassignedTeamsCount":unassignedTeams,
+                    "assignedAssignmentsCount":len(assignmentStatuses)-unassignedAssignments-completedAssignments,
+                    "unassignedAssignmentsCount":unassignedAssignments,
+                    "completedAssignmentsCount":completedAssignments}
+            return dict(self.countsCache)
+
+    # lookup - return column col of the row of table whose column keyCol equals key,
+    #  using the model's indexes (the row's ID, or the team / assignment name);
+    #  returns [True,value] if the model can answer (value is None if there is
+    #  no such row), or [False,None] if it can't, e.g. for ID -1 (not finalized),
+    #  which may match more than one row
+    def lookup(self,table,keyCol,key,col):
+        if keyCol==BOARD_TABLES[table]:
+            try:
+                key=int(key)
+            except (TypeError,ValueError):
+                return [False,None]
+            if key<=0:
+                return [False,None]
+            n=self.nByID[table].get(key)
+        elif table=='Teams' and keyCol=='TeamName':
+            n=self.teamNByName.get(str(key)) # names are stored as text
+        elif table=='Assignments' and keyCol=='AssignmentName':
+            n=self.assignmentNByName.get(str(key))
+        else:
+            return [False,None]
+        if n is None:
+            return [True,None]
+        return [True,self.rows[table][n][col]]
+
+    def getMedicalTeams(self):
+        with self.lock:
+            self.ensureCurrent()
+            if self.medicalTeams is None:
+                teams=self.rows['Teams']
+                self.medicalTeams=[teams[n]['TeamName'] for n in sorted(teams) if teams[n]['Medical']=='YES']
+            return list(self.medicalTeams)
+
+board=BoardModel()
+
+# boardRefresh - re-read the rows of table whose column col has the specified
+#  value (e.g. 'Teams','tid',5 or 'Teams','n',12), and put them into the board
+#  model, or remove them from the model if they no longer exist; call this
+#  after writing to the database.  If the caller just selected those rows,
+#  pass them as rows to avoid another query.
+def boardRefresh(table,col,value,rows=None):
+    if isinstance(value,str) and value.lstrip('-').isdigit(): # IDs from API request URLs are strings
+        value=int(value)
+    if rows is None:
+        rows=q("SELECT * FROM '"+table+"' WHERE "+col+" = ?;",(value,))
+        if rows is None: # query error
+            return
+    logChanges(table,[row['n'] for row in rows])
+    with board.lock:
+        version=bumpBoardVersion()
+        if not board.loaded or version!=board.version+1: # someone else changed the database
+            board.load()
+            return
+        board.version=version
+        board.checkedAt=time.monotonic()
+        if col=='n':
+            ns=[value]
+        elif col==BOARD_TABLES[table] and value is not None and value>0:
+            ns=[board.nByID[table].get(value)]
+        else:
+            ns=[n for (n,row) in board.rows[table].items() if row[col]==value]
+        for n in ns:
+            if n is not None:
+                board.remove(table,n)
+        for row in rows:
+            board.put(table,row)
+
+# tdbBoardRefresh - for code that writes to the database directly using q(),
+#  e.g. the client sync handler: update the board model rows for the given IDs
+def tdbBoardRefresh(tid=None,aid=None,pid=None):
+    if tid is not None:
+        boardRefresh('Teams','tid',tid)
+    if aid is not None:
+        boardRefresh('Assignments','aid',aid)
+    if pid is not None:
+        boardRefresh('Pairings','pid',pid)
+
+# tdbCheckBoard - compare the board model with the database; returns a list of
+#  discrepancies, which will be empty if the model is consistent
+def tdbCheckBoard():
+    errors=[]
+    with board.lock:
+        board.ensureCurrent()
+        for table in BOARD_TABLES:
+            dbRows={row['n']:row for row in q("SELECT * FROM '"+table+"';") or []}
+            modelRows=board.rows[table]
+            for n in set(dbRows)|set(modelRows):
+                if dbRows.get(n)!=modelRows.get(n):
+                    errors.append(table+' n='+str(n)+': database='+str(dbRows.get(n))+' model='+str(modelRows.get(n)))
+        if board.teamsView()!=getTeamsViewFromDB():
+            errors.append('teams view does not match the database')
+        if board.assignmentsView()!=getAssignmentsViewFromDB():
+            errors.append('assignments view does not match the database')
+        medical=q("SELECT TeamName FROM 'Teams' WHERE Medical == 'YES' ORDER BY n;") or []
+        if board.getMedicalTeams()!=[x['TeamName'] for x in medical]:
+            errors.append('medical teams list does not match the database')
+    for error in errors:
+        logging.warning('board model check: '+error)
+    return errors
+    
+#####################################
+## CHANGE FEED
+#####################################
+## every change that the host makes to a Teams, Assignments, Pairings or
+##   History row is recorded in the ChangeLog table, with a strictly
+##   increasing sequence number.  There is one entry per row: a later change
+##   to the same row replaces its entry, with a new sequence number.  Clients
+##   sync by asking for everything after the last sequence number they
+##   received (tdbGetChanges), so an idle poll returns nothing, each change is
+##   sent to each client once, and clock differences don't matter.
+## Teams, Assignments and Pairings changes are recorded by boardRefresh,
+##   which every mutator calls; History entries by tdbAddHistoryEntry.
+## after each change is committed, the host also sends a small notification,
+##   {'type':'changes','seq':<latest sequence number>,'incident':<incident ID>},
+##   over the same websocket repeater / pusher.com channel as the board pushes,
+##   so clients can sync as soon as something changes instead of polling
+##   (browser viewers ignore it).
+
+CHANGE_TABLES=['Teams','Assignments','Pairings','History']
+
+def createChangeLogTableIfNeeded():
+    q('CREATE TABLE IF NOT EXISTS "ChangeLog" ("seq" INTEGER PRIMARY KEY AUTOINCREMENT, "TableName" TEXT, "n" INTEGER, UNIQUE("TableName","n"));')
+
+def logChanges(table,ns):
+    if not host: # clients get their changes from the host; they don't serve them
+        return
+    for n in ns:
+        q("INSERT OR REPLACE INTO 'ChangeLog' (TableName,n) VALUES (?,?);",(table,n))
+    if inBatch(): # notify once, after the batch has been committed
+        _connLocal.changesPending=True
+    else:
+        tdbNotifyChanges()
+
+def tdbNotifyChanges():
+    if not wsOk:
+        return
+    r=q("SELECT MAX(seq) AS seq FROM 'ChangeLog';")
+    msg={'type':'changes','seq':(r[0]['seq'] if r else None) or 0,'incident':tdbGetIncidentID()}
+    wsSend(json.dumps(msg),kind='changes')
+
+# tdbGetChanges - return all rows that changed after sequence number since, in
+#  one consistent read:
+#  {'seq':<latest sequence number>,'timestamp':<host time>,'incident':<incident ID>,
+#   'Teams':[...],'Assignments':[...],'Pairings':[...],'History':[...]}
+#  the client passes the returned seq as since in its next call.  If since is
+#  newer than anything in this database (e.g. the host database was
+#  re-initialized), all rows are returned.  A client that has not synced past
+#  the last archived history entry (e.g. one joining after tdbArchiveHistory
+#  has run) also gets the archived entries, which are no longer in ChangeLog.
+def tdbGetChanges(since=0):
+    since=int(since)
+    with tdbBatch(write=False):
+        r=q("SELECT MAX(seq) AS seq FROM 'ChangeLog';")
+        seq=(r[0]['seq'] if r else None) or 0
+        if since>seq:
+            since=0
+        d={'seq':seq,'timestamp':time.time(),'incident':tdbGetIncidentID()}
+        for table in CHANGE_TABLES:
+            d[table]=q("SELECT * FROM '"+table+"' WHERE n IN (SELECT n FROM 'ChangeLog' WHERE TableName=? AND seq > ?) ORDER BY n;",(table,since)) or []
+        r=q("SELECT Value FROM 'Meta' WHERE Key='HistoryArchivedSeq';")
+        if r and since<r[0]['Value']:
+            d['History']=(q("SELECT * FROM 'HistoryArchive' ORDER BY n;") or [])+d['History']
+    return d
+
+#####################################
+## SYNC APPLY
+#####################################
+## a client applies each tdbGetChanges result from the host with
+##   tdbApplySync: one UPSERT statement per table, run with executemany, all in
+##   one transaction, followed by at most one board model update and one push.
+##   A synced row is matched to the local row by its host ID; a row this client
+##   created that is still waiting for its host ID (-1) is matched by name
+##   instead, and picks up the host ID.  Rows are applied as-is: none of the
+##   status side effects or history entries of the tdbNew* functions, since
+##   the host has already done those and will send their results too.
+## the multiple ON CONFLICT clauses need sqlite 3.35 or newer, and the unique
+##   indexes of TABLE_INDEXES as their conflict targets; without either (older
+##   Android or Windows pythons, or a database whose unique indexes could not
+##   be created), each row is applied with UPDATE, then INSERT if no row was
+##   updated (syncUpdateInsert) - slower, but the same result.
+
+SYNC_UPSERTS={
+    'Teams':'''INSERT INTO 'Teams' (tid,TeamName,TeamStatus,Resource,Medical,LastEditEpoch)
+        VALUES (:tid,:TeamName,:TeamStatus,:Resource,:Medical,:LastEditEpoch)
+        ON CONFLICT(tid) WHERE tid > 0 DO UPDATE SET
+            TeamStatus=excluded.TeamStatus,Resource=excluded.Resource,
+            Medical=excluded.Medical,LastEditEpoch=excluded.LastEditEpoch
+        ON CONFLICT(TeamName) DO UPDATE SET tid=excluded.tid,
+            TeamStatus=excluded.TeamStatus,Resource=excluded.Resource,
+            Medical=excluded.Medical,LastEditEpoch=excluded.LastEditEpoch;''',
+    'Assignments':'''INSERT INTO 'Assignments' (aid,AssignmentName,AssignmentStatus,IntendedResource,sid,LastEditEpoch)
+        VALUES (:aid,:AssignmentName,:AssignmentStatus,:IntendedResource,:sid,:LastEditEpoch)
+        ON CONFLICT(aid) WHERE aid > 0 DO UPDATE SET
+            AssignmentStatus=excluded.AssignmentStatus,IntendedResource=excluded.IntendedResource,
+            sid=excluded.sid,LastEditEpoch=excluded.LastEditEpoch
+        ON CONFLICT(AssignmentName) DO UPDATE SET aid=excluded.aid,
+            AssignmentStatus=excluded.AssignmentStatus,IntendedResource=excluded.IntendedResource,
+            sid=excluded.sid,LastEditEpoch=excluded.LastEditEpoch;''',
+    'Pairings':'''INSERT INTO 'Pairings' (pid,aid,tid,PairingStatus,NameSave,ResourceSave,LastEditEpoch)
+        VALUES (:pid,:aid,:tid,:PairingStatus,:NameSave,:ResourceSave,:LastEditEpoch)
+        ON CONFLICT(pid) WHERE pid > 0 DO UPDATE SET
+            PairingStatus=excluded.PairingStatus,
+            NameSave=IFNULL(excluded.NameSave,NameSave),ResourceSave=IFNULL(excluded.ResourceSave,ResourceSave),
+            LastEditEpoch=excluded.LastEditEpoch;''',
+    'History':'''INSERT INTO 'History' (hid,aid,tid,Entry,RecordedBy,Epoch)
+        VALUES (:hid,:aid,:tid,:Entry,:RecordedBy,:Epoch)
+        ON CONFLICT(hid) WHERE hid > 0 DO UPDATE SET Epoch=excluded.Epoch;'''}
+
+SYNC_UPSERT_COLS={
+    'Teams':TEAM_COLS,
+    'Assignments':ASSIGNMENT_COLS,
+    'Pairings':PAIRING_COLS,
+    'History':HISTORY_COLS}
+
+# for syncUpdateInsert: the host ID column, the name column a pending (-1) row
+#  is matched by, and the columns that an update sets, as in SYNC_UPSERTS
+SYNC_ID_COLS={'Teams':'tid','Assignments':'aid','Pairings':'pid','History':'hid'}
+SYNC_NAME_COLS={'Teams':'TeamName','Assignments':'AssignmentName'}
+SYNC_UPDATE_COLS={
+    'Teams':['TeamStatus','Resource','Medical','LastEditEpoch'],
+    'Assignments':['AssignmentStatus','IntendedResource','sid','LastEditEpoch'],
+    'Pairings':['PairingStatus','NameSave','ResourceSave','LastEditEpoch'],
+    'History':['Epoch']}
+SYNC_KEEP_IF_NULL=['NameSave','ResourceSave'] # a synced NULL doesn't replace a saved value
+
+syncUpserts=sqlite3.sqlite_version_info>=(3,35,0) # see checkSyncUpserts
+
+# checkSyncUpserts - use SYNC_UPSERTS only if this sqlite can run them and the
+#  unique indexes they depend on exist; called by tdbUpgradeSchema
+def checkSyncUpserts():
+    global syncUpserts
+    syncUpserts=sqlite3.sqlite_version_info>=(3,35,0)
+    if not syncUpserts:
+        logging.warning('sqlite '+sqlite3.sqlite_version+' is older than 3.35; sync will use UPDATE / INSERT instead of UPSERT')
+        return
+    for [name,table,columns,unique,condition] in TABLE_INDEXES:
+        if unique and table in SYNC_UPSERTS:
+            if not any(x['name']==name and x['unique'] for x in q("PRAGMA index_list('"+table+"');") or []):
+                logging.error('unique index '+name+' is missing; sync will use UPDATE / INSERT instead of UPSERT')
+                syncUpserts=False
+
+def syncUpdateInsert(table,rows):
+    idCol=SYNC_ID_COLS[table]
+    nameCol=SYNC_NAME_COLS.get(table)
+    cols=[col[0] for col in SYNC_UPSERT_COLS[table]]
+    setClause=', '.join([col+'=IFNULL(:'+col+','+col+')' if col in SYNC_KEEP_IF_NULL else col+'=:'+col for col in SYNC_UPDATE_COLS[table]])
+    for row in rows:
+        params={col:row.get(col) for col in cols}
+        if q("UPDATE '"+table+"' SET "+setClause+" WHERE "+idCol+"=:"+idCol+" AND "+idCol+" > 0;",params):
+            continue
+        if nameCol and q("UPDATE '"+table+"' SET "+idCol+"=:"+idCol+", "+setClause+" WHERE "+nameCol+"=:"+nameCol+";",params):
+            continue
+        qInsert(table,params)
+
+# above this many synced board rows, reloading the whole board model is cheaper
+#  than looking up and replacing each row
+SYNC_RELOAD_ROWS=200
+
+# tdbApplySync - apply the Teams/Assignments/Pairings/History lists of a sync
+#  result; returns {<table>:<number of rows applied>,...,'ms':<elapsed time>},
+#  or None if the transaction failed and was rolled back
+def tdbApplySync(result):
+    t0=time.perf_counter()
+    counts={}
+    try:
+        with tdbBatch():
+            for table in CHANGE_TABLES:
+                rows=result.get(table) or []
+                counts[table]=len(rows)
+                if not rows:
+                    continue
+                if not syncUpserts:
+                    syncUpdateInsert(table,rows)
+                    continue
+                cols=[col[0] for col in SYNC_UPSERT_COLS[table]]
+                qMany(SYNC_UPSERTS[table],[{col:row.get(col) for col in cols} for row in rows]) # raises on failure, inside the batch
+            syncBoardRefresh(result)
+    except sqlite3.Error as e:
+        logging.warning(str(e)+'; the sync result was not applied')
+        return None
+    counts['ms']=round((time.perf_counter()-t0)*1000,1)
+    return counts
+
+# syncBoardRefresh - update the board model with the rows just written by tdbApplySync
+def syncBoardRefresh(result):
+    ids={table:[row[col] for row in result.get(table) or []] for (table,col) in BOARD_TABLES.items()}
+    total=sum(len(x) for x in ids.values())
+    if total==0:
+        return
+    with board.lock:
+        version=bumpBoardVersion()
+        if not board.loaded or version!=board.version+1 or total>SYNC_RELOAD_ROWS:
+            board.load()
+        else:
+            board.version=version
+            board.checkedAt=time.monotonic()
+            for (table,col) in BOARD_TABLES.items():
+                if not ids[table]:
+                    continue
+                for row in q("SELECT * FROM '"+table+"' WHERE "+col+" IN ("+','.join('?'*len(ids[table]))+");",ids[table]) or []:
+                    board.put(table,row) # put replaces the old row with the same n
+    # put marks the view rows dirty; they are rebuilt when next shown.  Only
+    #  the host has viewers to push to; a client would build both views for nothing
+    if host and wsOk:
+        tdbPushTables()
+
+#####################################
+## CONDITIONAL GETS
+#####################################
+## API handlers for GET requests (sync, history, views) can answer
+##   '304 Not Modified', with no body, when nothing has changed since the
+##   client's previous request:
+##     etag=tdbGetETag()
+##     if tdbCheckETag(request.headers.get('If-None-Match'),etag):
+##         return '',304,{'ETag':etag}
+##     ...build the response as usual, with the header ETag: etag
+## the tag is the incident ID plus the latest change feed sequence number, so
+##   it changes whenever anything the host serves changes (or the database is
+##   re-initialized), and it costs one indexed query.  Since a sync response
+##   depends on the requested sequence number too, clients keep one tag per URL.
+
+etagStats={'checked':0,'notModified':0}
+
+def tdbGetETag():
+    r=q("SELECT MAX(seq) AS seq FROM 'ChangeLog';")
+    seq=(r[0]['seq'] if r else None) or 0
+    return '"'+str(tdbGetIncidentID())+'-'+str(seq)+'"'
+
+# tdbCheckETag - True if the client's If-None-Match header matches etag, i.e.
+#  the response would be the same as the one the client already has
+def tdbCheckETag(ifNoneMatch,etag):
+    etagStats['checked']+=1
+    if ifNoneMatch and etag in [x.strip() for x in ifNoneMatch.split(',')]:
+        etagStats['notModified']+=1
+        return True
+    return False
+
+def tdbGetETagStats():
+    return dict(etagStats)
+
+#####################################
+## HOST ID COUNTERS
+#####################################
+## only the host assigns tid/aid/pid/hid values.  The next value for each is
+##   kept in the Meta table (keys nextTid, nextAid, nextPid, nextHid) and
+##   incremented in the same transaction as the insert that uses it, so a
+##   restarted host - or another web server process using the same database
+##   file - never hands out an ID that is already in use.
+
+HOST_ID_TABLES={ # ID column : table
+    'tid':'Teams',
+    'aid':'Assignments',
+    'pid':'Pairings',
+    'hid':'History'}
+
+def hostIDKey(col):
+    return 'next'+col.capitalize()
+
+def nextHostID(col):
+    key=hostIDKey(col)
+    with tdbBatch():
+        r=q("SELECT Value FROM 'Meta' WHERE Key=?;",(key,))
+        id=r[0]['Value'] if r else 1
+        q("INSERT OR REPLACE INTO 'Meta' (Key,Value) VALUES (?,?);",(key,id+1))
+    return id
+
+# initHostIDs - make sure each counter is past the largest ID in its table; this
+#  covers databases written before the counters were stored
+def initHostIDs():
+    with tdbBatch():
+        for (col,table) in HOST_ID_TABLES.items():
+            key=hostIDKey(col)
+            r=q("SELECT (SELECT IFNULL(MAX("+col+"),0)+1 FROM '"+table+"') AS n, (SELECT Value FROM 'Meta' WHERE Key=?) AS Value;",(key,))
+            q("INSERT OR REPLACE INTO 'Meta' (Key,Value) VALUES (?,?);",(key,max(r[0]['n'],r[0]['Value'] or 1)))
+
+def tdbGetIncidentID():
+    r=q("SELECT Value FROM 'Meta' WHERE Key='IncidentID';")
+    if r:
+        return r[0]['Value']
+    return None
+
 #####################################
 ## BEGIN SDB FUNCTIONS
 #####################################
@@ -255,101 +1303,112 @@ def qInsert(tableName,d):
 
 def tdbNewTeam(name,resource,status=None,medical='NO',tid=None,lastEditEpoch=None):
     # status, tid, and lastEditEpoch arguments will only exist if this is being called from sync handler
-    if host: # this clause will only run on the host
-        global nextTid
-        tid=nextTid
-        nextTid+=1
-    else:
-        tid=tid or -1
-    lee=lastEditEpoch or round(time.time(),2)
-    d={}
-    d['tid']=tid
-    d['TeamName']=name
-    d['Resource']=resource
-    d['Medical']=medical
-    d['LastEditEpoch']=lee
-    if status: # use the default status unless specified
-        d['TeamStatus']=status
-        logging.info("  inserting d:"+str(d))
-    qInsert('Teams',d)
-    r=q('SELECT * FROM Teams ORDER BY n DESC LIMIT 1;')
-    # when called from sync handler: don't write a history entry
-    if not status: # status arg will only exist when called from sync handler
-        if host:
-            tdbAddHistoryEntry('New Team: '+name,tid=r[0]['tid'],recordedBy='SYSTEM')
-    validate=r[0]
-    tdbPushTables()
+    try:
+        with tdbBatch(): # one transaction for the new ID, the team, and its history entry
+            if host: # this clause will only run on the host
+                tid=nextHostID('tid')
+            else:
+                tid=tid or -1
+            lee=lastEditEpoch or round(time.time(),2)
+            d={}
+            d['tid']=tid
+            d['TeamName']=name
+            d['Resource']=resource
+            d['Medical']=medical
+            d['LastEditEpoch']=lee
+            if status: # use the default status unless specified
+                d['TeamStatus']=status
+                logging.info("  inserting d:"+str(d))
+            qInsert('Teams',d)
+            r=q('SELECT * FROM Teams ORDER BY n DESC LIMIT 1;')
+            boardRefresh('Teams','n',r[0]['n'],r)
+            # when called from sync handler: don't write a history entry
+            if not status: # status arg will only exist when called from sync handler
+                if host:
+                    tdbAddHistoryEntry('New Team: '+name,tid=r[0]['tid'],recordedBy='SYSTEM')
+            validate=r[0]
+            tdbPushTables()
+    except sqlite3.IntegrityError as e: # e.g. the name is already taken (unique index)
+        logging.warning('new team '+str(name)+' not added: '+str(e))
+        return {'error':'Team '+str(name)+' already exists'}
     return {'validate':validate}
 
 def tdbNewAssignment(name,intendedResource,status=None,aid=None,sid=None,lastEditEpoch=None):
     # status, aid, and lastEditEpoch arguments will only exist if this is being called from sync handler
-    if host:
-        global nextAid
-        aid=nextAid
-        nextAid+=1
-    else:
-        aid=aid or -1
-    lee=lastEditEpoch or round(time.time(),2)
-    d={}
-    d['aid']=aid
-    d['AssignmentName']=name
-    d['IntendedResource']=intendedResource
-    d['LastEditEpoch']=lee
-    if status: # use the default status unless specified
-        d['AssignmentStatus']=status
-    if sid:
-        d['sid']=sid
-    qInsert('Assignments',d)
-    r=q('SELECT * FROM Assignments ORDER BY n DESC LIMIT 1;')
-    # when called from sync handler: don't write a history entry
-    if not status: # status arg will only exist when called from sync handler
-        if host:
-            tdbAddHistoryEntry('New Assignment: '+name,aid=r[0]['aid'],recordedBy='SYSTEM')
-    validate=r[0]
-    tdbPushTables()
+    try:
+        with tdbBatch(): # one transaction for the new ID, the assignment, and its history entry
+            if host:
+                aid=nextHostID('aid')
+            else:
+                aid=aid or -1
+            lee=lastEditEpoch or round(time.time(),2)
+            d={}
+            d['aid']=aid
+            d['AssignmentName']=name
+            d['IntendedResource']=intendedResource
+            d['LastEditEpoch']=lee
+            if status: # use the default status unless specified
+                d['AssignmentStatus']=status
+            if sid:
+                d['sid']=sid
+            qInsert('Assignments',d)
+            r=q('SELECT * FROM Assignments ORDER BY n DESC LIMIT 1;')
+            boardRefresh('Assignments','n',r[0]['n'],r)
+            # when called from sync handler: don't write a history entry
+            if not status: # status arg will only exist when called from sync handler
+                if host:
+                    tdbAddHistoryEntry('New Assignment: '+name,aid=r[0]['aid'],recordedBy='SYSTEM')
+            validate=r[0]
+            tdbPushTables()
+    except sqlite3.IntegrityError as e: # e.g. the name is already taken (unique index)
+        logging.warning('new assignment '+str(name)+' not added: '+str(e))
+        return {'error':'Assignment '+str(name)+' already exists'}
     return {'validate':validate}
 
 def tdbNewPairing(aid,tid,status=None,pid=None,lastEditEpoch=None):
-    if host:
-        global nextPid
-        pid=nextPid
-        nextPid+=1
-    else:
-        pid=pid or -1
-    lee=lastEditEpoch or round(time.time(),2)
-    d={}
-    d['pid']=pid
-    d['aid']=aid
-    d['tid']=tid
-    d['LastEditEpoch']=lee
-    if status: # use the default status unless specified
-        d['PairingStatus']=status
-    assignmentName=tdbGetAssignmentNameByID(aid)
-    teamName=tdbGetTeamNameByID(tid)
-    # when called from sync handler: leave team and assignment status as they are,
-    #  and don't write a history entry
-    if not status: # status arg will only exist when called from sync handler
-        tdbSetTeamStatusByID(tid,'ASSIGNED',push=False) # don't push tables yet
-        tdbSetAssignmentStatusByID(aid,'ASSIGNED',push=False) # don't push tables yet
+    with tdbBatch(): # one transaction and one push for the new ID, statuses, history entry, and pairing
         if host:
-            tdbAddHistoryEntry('New Pairing: '+assignmentName+'+'+teamName,aid=aid,tid=tid,recordedBy='SYSTEM')
-    qInsert('Pairings',d)
-    r=q('SELECT * FROM Pairings ORDER BY n DESC LIMIT 1;')
-    validate=r[0]
-    tdbPushTables()
+            pid=nextHostID('pid')
+        else:
+            pid=pid or -1
+        lee=lastEditEpoch or round(time.time(),2)
+        d={}
+        d['pid']=pid
+        d['aid']=aid
+        d['tid']=tid
+        d['LastEditEpoch']=lee
+        if status: # use the default status unless specified
+            d['PairingStatus']=status
+        assignmentName=tdbGetAssignmentNameByID(aid)
+        teamName=tdbGetTeamNameByID(tid)
+        # when called from sync handler: leave team and assignment status as they are,
+        #  and don't write a history entry
+        if not status: # status arg will only exist when called from sync handler
+            tdbSetTeamStatusByID(tid,'ASSIGNED')
+            tdbSetAssignmentStatusByID(aid,'ASSIGNED')
+            if host:
+                tdbAddHistoryEntry('New Pairing: '+assignmentName+'+'+teamName,aid=aid,tid=tid,recordedBy='SYSTEM')
+        qInsert('Pairings',d)
+        r=q('SELECT * FROM Pairings ORDER BY n DESC LIMIT 1;')
+        boardRefresh('Pairings','n',r[0]['n'],r)
+        validate=r[0]
+        tdbPushTables()
     return {'validate':validate}
 
 def tdbNewTeamFinalize(n,tid,lastEditEpoch):
     # logging.info("New team finalize:"+str(n)+"="+str(tid))
     q("UPDATE 'Teams' SET tid = '"+str(tid)+"', LastEditEpoch = '"+str(lastEditEpoch)+"' WHERE n = '"+str(n)+"';")
+    boardRefresh('Teams','n',n)
 
 def tdbNewAssignmentFinalize(n,aid,lastEditEpoch):
     # logging.info("New assignment finalize:"+str(n)+"="+str(aid))
     q("UPDATE 'Assignments' SET aid = '"+str(aid)+"', LastEditEpoch = '"+str(lastEditEpoch)+"' WHERE n = '"+str(n)+"';")
+    boardRefresh('Assignments','n',n)
 
 def tdbNewPairingFinalize(n,pid,lastEditEpoch):
     # logging.info("New pairing finalize:"+str(n)+"="+str(pid))
     q("UPDATE 'Pairings' SET pid = '"+str(pid)+"', LastEditEpoch = '"+str(lastEditEpoch)+"' WHERE n = '"+str(n)+"';")
+    boardRefresh('Pairings','n',n)
 
 # no need to finalize history entries:
 #  all history entries are initially created on the server anyway;
@@ -367,97 +1426,93 @@ def tdbHome():
             <p>API for interacting with the Assignment Tracker databases</p>'''
 
 
-# team getters
-def tdbGetTeamIDByName(teamName):
-    query="SELECT tid FROM 'Teams' WHERE TeamName='"+str(teamName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
+# name <-> ID lookups: answered from the board model's indexes when possible,
+#  which boardRefresh keeps up to date for every create, change, delete and
+#  sync; otherwise (e.g. ID -1) from the database as before.
+# lookupStats: hits were answered with no query at all; checked were answered
+#  from the model after a query of the board version; misses queried the row
+lookupStats={'hits':0,'checked':0,'misses':0}
+
+def boardLookup(table,keyCol,key,col):
+    with board.lock:
+        checked=board.ensureCurrent(BOARD_LOOKUP_MAX_AGE)
+        [found,value]=board.lookup(table,keyCol,key,col)
+    if found:
+        lookupStats['checked' if checked else 'hits']+=1
+        return value
+    lookupStats['misses']+=1
+    r=q("SELECT "+col+" FROM '"+table+"' WHERE "+keyCol+"=?;",(key,))
     if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("tid",None)
+        return r[0].get(col,None)
     else:
         return None
 
+# boardLookupMany - resolve a list of keys in one call; one model check for all of them
+def boardLookupMany(table,keyCol,keys,col):
+    values=[]
+    missed=[]
+    with board.lock:
+        checked=board.ensureCurrent(BOARD_LOOKUP_MAX_AGE)
+        for key in keys:
+            [found,value]=board.lookup(table,keyCol,key,col)
+            values.append(value)
+            if not found:
+                missed.append(len(values)-1)
+    found=len(keys)-len(missed)
+    if checked and found:
+        lookupStats['checked']+=1 # the first one paid for the check
+        found-=1
+    lookupStats['hits']+=found
+    lookupStats['misses']+=len(missed)
+    for i in missed:
+        r=q("SELECT "+col+" FROM '"+table+"' WHERE "+keyCol+"=?;",(keys[i],))
+        if r:
+            values[i]=r[0].get(col,None)
+    return values
+
+def tdbGetLookupStats():
+    return dict(lookupStats)
+
+def tdbGetTeamNamesByIDs(tids):
+    return boardLookupMany('Teams','tid',tids,'TeamName')
+
+def tdbGetTeamIDsByNames(teamNames):
+    return boardLookupMany('Teams','TeamName',teamNames,'tid')
+
+def tdbGetAssignmentNamesByIDs(aids):
+    return boardLookupMany('Assignments','aid',aids,'AssignmentName')
+
+def tdbGetAssignmentIDsByNames(assignmentNames):
+    return boardLookupMany('Assignments','AssignmentName',assignmentNames,'aid')
+
+# team getters
+def tdbGetTeamIDByName(teamName):
+    return boardLookup('Teams','TeamName',teamName,'tid')
+
 def tdbGetTeamNameByID(tid):
-    query="SELECT TeamName FROM 'Teams' WHERE tid='"+str(tid)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("TeamName",None)
-    else:
-        return None
+    return boardLookup('Teams','tid',tid,'TeamName')
 
 def tdbGetTeamStatusByName(teamName):
-    query="SELECT TeamStatus FROM 'Teams' WHERE TeamName='"+str(teamName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("TeamStatus",None)
-    else:
-        return None
+    return boardLookup('Teams','TeamName',teamName,'TeamStatus')
 
 def tdbGetTeamResourceByName(teamName):
-    query="SELECT Resource FROM 'Teams' WHERE TeamName='"+str(teamName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("Resource",None)
-    else:
-        return None
+    return boardLookup('Teams','TeamName',teamName,'Resource')
 
 def tdbGetTeamMedicalByName(teamName):
-    query="SELECT Medical FROM 'Teams' WHERE TeamName='"+str(teamName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("Medical",None)
-    else:
-        return None
+    return boardLookup('Teams','TeamName',teamName,'Medical')
 
 # assignment getters
 def tdbGetAssignmentNameByID(aid):
-    query="SELECT AssignmentName FROM 'Assignments' WHERE aid='"+str(aid)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("AssignmentName",None)
-    else:
-        return None
+    return boardLookup('Assignments','aid',aid,'AssignmentName')
 
 def tdbGetAssignmentIDByName(assignmentName):
-    query="SELECT aid FROM 'Assignments' WHERE AssignmentName='"+str(assignmentName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("aid",None)
-    else:
-        return None
+    return boardLookup('Assignments','AssignmentName',assignmentName,'aid')
 
 def tdbGetAssignmentStatusByName(assignmentName):
-    query="SELECT AssignmentStatus FROM 'Assignments' WHERE AssignmentName='"+str(assignmentName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("AssignmentStatus",None)
-    else:
-        return None
+    return boardLookup('Assignments','AssignmentName',assignmentName,'AssignmentStatus')
 
 def tdbGetAssignmentIntendedResourceByName(assignmentName):
-    query="SELECT IntendedResource FROM 'Assignments' WHERE AssignmentName='"+str(assignmentName)+"';"
-    # logging.info("query:"+query)
-    r=q(query)
-    # logging.info("response:"+str(r))
-    if type(r) is list and len(r)>0 and type(r[0]) is dict:
-        return r[0].get("IntendedResource",None)
-    else:
-        return None
+    return boardLookup('Assignments','AssignmentName',assignmentName,'IntendedResource')
 
 
 def tdbGetTeams(tid=None,since=None):
@@ -476,30 +1531,175 @@ def tdbGetTeams(tid=None,since=None):
 #    to create the teams view RecycleView data, or, to generate the html table
 #    for downstream html views i.e. pushed using websockets
 def tdbGetTeamsView():
+    return board.teamsView()
+
+# getTeamsViewFromDB - build the same list directly from the database; used
+#    to check the board model
+def getTeamsViewFromDB():
     # logging.info('****************** tdbGetTeamsView called')
+    # one query: every team, joined with each of its pairings (if any) and the
+    #  paired assignment name; rows come back grouped by team, in the same order
+    #  as the Teams and Pairings tables, so a single pass builds the view
+    rows=q("""SELECT t.n, t.TeamName, t.TeamStatus, t.Resource,
+                p.PairingStatus, a.AssignmentName
+            FROM Teams t
+            LEFT JOIN Pairings p ON p.tid = t.tid
+            LEFT JOIN Assignments a ON a.aid = p.aid
+            ORDER BY t.n, p.n;""") or []
     teamsList=[]
-    tdbTeams=tdbGetTeams()
-    tdbPairings=tdbGetPairings()
-    for entry in tdbTeams:
-        tid=entry['tid']
-        pairings=[x for x in tdbPairings if x['tid']==tid] # pairings that include this team
-        currentPairings=[x for x in pairings if x['PairingStatus']=='CURRENT']
-        previousPairings=[x for x in pairings if x['PairingStatus']=='PREVIOUS']
-        currentAssignments=[tdbGetAssignmentNameByID(x['aid']) for x in currentPairings]
-        previousAssignments=[tdbGetAssignmentNameByID(x['aid']) for x in previousPairings]
-        # Logger.info('Assignments for '+str(entry['TeamName'])+':'+str(assignments))
-        teamsList.append([
-            entry['TeamName'],
-            ','.join(currentAssignments) or '--',
-            entry['TeamStatus'],
-            entry['Resource'],
-            ','.join(previousAssignments) or '--'])
+    n=None
+    for row in rows:
+        if row['n']!=n: # first row for this team
+            n=row['n']
+            currentAssignments=[]
+            previousAssignments=[]
+            teamsList.append([row['TeamName'],currentAssignments,row['TeamStatus'],row['Resource'],previousAssignments])
+        if row['AssignmentName'] is not None:
+            if row['PairingStatus']=='CURRENT':
+                currentAssignments.append(row['AssignmentName'])
+            elif row['PairingStatus']=='PREVIOUS':
+                previousAssignments.append(row['AssignmentName'])
+    for entry in teamsList:
+        entry[1]=','.join(entry[1]) or '--'
+        entry[4]=','.join(entry[4]) or '--'
     # logging.info('teamsList at end of tdbGetTeamsView:'+str(teamsList))
     return teamsList
 
 def tdbGetMedicalTeams():
-    r=q("SELECT TeamName FROM 'Teams' WHERE Medical == 'YES'")
-    return [x['TeamName'] for x in r]
+    return board.getMedicalTeams()
+
+# tdbGetCounts - the five team / assignment counts that tdbPushTables returns,
+#  without building or pushing the views
+def tdbGetCounts():
+    return board.counts()
+
+#####################################
+## DELTA PUSHES
+#####################################
+## instead of pushing both full views every time anything changes, push only
+##   the rows that changed since the previous push.  Rows are keyed: teams view
+##   rows by team name, assignments view rows by assignment name + team name
+##   (completed pairings get a separate key, since the same assignment and team
+##   can have a current pairing and a completed one).  Each push has a sequence
+##   number one greater than the previous push; a viewer that sees a gap in
+##   the sequence (e.g. a dropped message, or a viewer that just connected)
+##   asks for a snapshot, i.e. the full keyed views, by sending a
+##   'snapshotRequest' message.  A snapshot is also sent every
+##   PUSH_SNAPSHOT_INTERVAL seconds by a timer on the host (snapshotTimer),
+##   whether or not anything has changed, so that a viewer that cannot send
+##   requests (pusher.com) recovers on its own.
+## viewers add upserted rows with new keys at the end; when that would not
+##   give the same row order as the views, the delta also has the full key
+##   order for that view.
+##
+## delta:     {'type':'delta','seq':N,
+##             'teams':{'upsert':[[key,row],...],'remove':[key,...],'order':[key,...]},
+##             'assignments':{'upsert':[[key,row],...],'remove':[key,...],'order':[key,...]},
+##             'medicalTeams':[...]}  (order and medicalTeams only if they changed)
+## snapshot:  {'type':'snapshot','seq':N,
+##             'teams':[[key,row],...],'assignments':[[key,row],...],
+##             'medicalTeams':[...]}
+
+pushDeltas=True # set to False to push the full (legacy) message every time
+PUSH_SNAPSHOT_INTERVAL=60 # seconds
+
+_pushLock=threading.Lock()
+pushState={
+    'seq':0,
+    'teams':None, # {key:row} as of the last push; None = next push is a snapshot
+    'assignments':None,
+    'medicalTeams':None,
+    'lastSnapshotTime':0}
+pushStats={'deltas':0,'snapshots':0,'skipped':0,'bytes':0}
+
+def keyTeamsViewRows(rows):
+    return {row[0]:row for row in rows}
+
+def keyAssignmentsViewRows(rows):
+    d={}
+    for row in rows:
+        key=str(row[0])+'+'+str(row[1])
+        if row[2]=='COMPLETED':
+            key='C:'+key
+        k=key
+        i=2
+        while k in d: # should not happen, but don't lose rows if it does
+            k=key+'#'+str(i)
+            i+=1
+        d[k]=row
+    return d
+
+def diffKeyedRows(old,new):
+    d={
+        'upsert':[[k,row] for (k,row) in new.items() if old.get(k)!=row],
+        'remove':[k for k in old if k not in new]}
+    # the order a viewer ends up with: old keys in place, new keys at the end
+    viewerOrder=[k for k in old if k in new]+[k for k in new if k not in old]
+    if viewerOrder!=list(new):
+        d['order']=list(new)
+    return d
+
+# makePushMessage - return the message (a dict) to push for the given views,
+#  or None if nothing has changed since the previous push
+def makePushMessage(teamsViewList,assignmentsViewList,medicalTeamsList):
+    teams=keyTeamsViewRows(teamsViewList)
+    assignments=keyAssignmentsViewRows(assignmentsViewList)
+    snapshot=pushState['teams'] is None or time.time()-pushState['lastSnapshotTime']>PUSH_SNAPSHOT_INTERVAL
+    if snapshot:
+        msg={
+            'type':'snapshot',
+            'teams':[[k,row] for (k,row) in teams.items()],
+            'assignments':[[k,row] for (k,row) in assignments.items()],
+            'medicalTeams':medicalTeamsList}
+        pushState['lastSnapshotTime']=time.time()
+    else:
+        msg={
+            'type':'delta',
+            'teams':diffKeyedRows(pushState['teams'],teams),
+            'assignments':diffKeyedRows(pushState['assignments'],assignments)}
+        if medicalTeamsList!=pushState['medicalTeams']:
+            msg['medicalTeams']=medicalTeamsList
+        elif not any(msg[x]['upsert'] or msg[x]['remove'] for x in ['teams','assignments']):
+            return None
+    pushState['teams']=teams
+    pushState['assignments']=assignments
+    pushState['medicalTeams']=medicalTeamsList
+    pushState['seq']+=1
+    msg['seq']=pushState['seq']
+    return msg
+
+# tdbRequestSnapshot - make the next push a full snapshot; call this when a viewer
+#  sends a 'snapshotRequest' message; push=True sends the snapshot right away
+def tdbRequestSnapshot(push=True):
+    with _pushLock:
+        pushState['teams']=None
+    if push:
+        tdbPushTables()
+
+# snapshotTimer - runs on the host: push a snapshot whenever PUSH_SNAPSHOT_INTERVAL
+#  seconds have gone by without one
+def snapshotTimer():
+    while True:
+        time.sleep(max(1,pushState['lastSnapshotTime']+PUSH_SNAPSHOT_INTERVAL-time.time()))
+        if wsOk and pushDeltas and time.time()-pushState['lastSnapshotTime']>=PUSH_SNAPSHOT_INTERVAL:
+            try:
+                tdbRequestSnapshot()
+            except Exception as e:
+                logging.warning('periodic snapshot failed: '+str(e))
+
+_snapshotThread=None
+
+def startSnapshotTimer():
+    global _snapshotThread
+    if _snapshotThread is None:
+        _snapshotThread=threading.Thread(target=snapshotTimer,name='snapshotTimer',daemon=True)
+        _snapshotThread.start()
+
+def tdbGetPushStats():
+    with _pushLock:
+        d=dict(pushStats)
+        d['seq']=pushState['seq']
+    return d
 
 # tdbUpdateTables can also be used to get the team and assignment counts
 #  but, can't use the assignments view since it's actually a list of
@@ -528,8 +1728,23 @@ def tdbPushTables(teamsViewList=None,assignmentsViewList=None):
         "unassignedAssignmentsCount":len(assignmentsViewUnassignedList),
         "completedAssignmentsCount":len(assignmentsViewCompletedList),
         "medicalTeams":medicalTeamsList}
-    if wsOk: # wsSend will send over URL or over pusher.com as appropriate
-        wsSend(json.dumps(d))
+    if inBatch(): # push once, at the end of the batch
+        _connLocal.pushPending=True
+    elif wsOk: # wsSend will send over URL or over pusher.com as appropriate
+        if pushDeltas:
+            # hold the lock while sending, so that pushes from different threads
+            #  are sent in sequence number order
+            with _pushLock:
+                msg=makePushMessage(teamsViewList,assignmentsViewList,medicalTeamsList)
+                if msg is None:
+                    pushStats['skipped']+=1
+                else:
+                    j=json.dumps(msg)
+                    pushStats[msg['type']+'s']+=1
+                    pushStats['bytes']+=len(j)
+                    wsSend(j,kind=msg['type'])
+        else:
+            wsSend(json.dumps(d),kind='full')
     return(d)
 
 def tdbGetAssignments(aid=None,since=None):
@@ -545,28 +1760,29 @@ def tdbGetAssignments(aid=None,since=None):
             condition=condition))
 
 def tdbGetAssignmentsView():
+    return board.assignmentsView()
+
+def getAssignmentsViewFromDB():
     # note that this is really a list of pairings (one pairing per row), unpaired assignments, and completed assignments
+    # one query: every assignment, joined with each of its pairings (if any)
+    #  and the paired team; rows come back grouped by assignment, in table order
+    rows=q("""SELECT a.n, a.AssignmentName, a.AssignmentStatus, a.IntendedResource,
+                p.pid, p.PairingStatus, p.NameSave, p.ResourceSave,
+                t.TeamName, t.TeamStatus, t.Resource
+            FROM Assignments a
+            LEFT JOIN Pairings p ON p.aid = a.aid
+            LEFT JOIN Teams t ON t.tid = p.tid
+            ORDER BY a.n, p.n;""") or []
     assignmentsList=[]
     previousAssignments=[]
-    tdbAssignments=tdbGetAssignments()
-    tdbPairings=tdbGetPairings()
-    for entry in tdbAssignments:
-        aid=entry['aid']
-        assignmentName=entry['AssignmentName']
-        assignmentStatus=entry['AssignmentStatus']
-        current=[]
-        pairings=[x for x in tdbPairings if x['aid']==aid] # pairings that include this assignment
-        if pairings:
-            logging.info("  pairings:"+str(pairings))
-            for pairing in pairings:
-                if pairing['PairingStatus']=='PREVIOUS':
-                    previousAssignments.append([assignmentName,pairing['NameSave'],'COMPLETED',pairing['ResourceSave']])
-                else:
-                    current.append(tdbGetTeamNameByID(pairing['tid']))
+    for row in rows:
+        assignmentName=row['AssignmentName']
+        if row['pid'] is None: # no pairings include this assignment
+            assignmentsList.append([assignmentName,'--',row['AssignmentStatus'],row['IntendedResource']])
+        elif row['PairingStatus']=='PREVIOUS':
+            previousAssignments.append([assignmentName,row['NameSave'],'COMPLETED',row['ResourceSave']])
         else:
-            assignmentsList.append([assignmentName,'--',assignmentStatus,tdbGetAssignmentIntendedResourceByName(assignmentName)])
-        for teamName in current:
-            assignmentsList.append([assignmentName,teamName,tdbGetTeamStatusByName(teamName),tdbGetTeamResourceByName(teamName)])
+            assignmentsList.append([assignmentName,row['TeamName'],row['TeamStatus'],row['Resource']])
     assignmentsList+=previousAssignments # list completed assignments at the end, until a separate list display is arranged
     return assignmentsList
     
@@ -609,22 +1825,24 @@ def tdbGetPairingIDByNames(assignmentName,teamName,currentOnly=False,previousOnl
     else:
         return None
 
-def tdbSetPairingStatusByID(pid,status):
+def tdbSetPairingStatusByID(pid,status,push=True):
     # logging.info("tdbSetPairingStatusByID called: pid="+str(pid)+" status="+str(status))
     [assignmentName,teamName]=tdbGetPairingNamesByID(pid)
     [aid,tid]=tdbGetPairingIDsByID(pid)
     if host:
         tdbAddHistoryEntry(assignmentName+'+'+teamName+' -> '+status,tid=tid,aid=aid)
     # what history entries if any should happen here?
-    q("UPDATE 'Pairings' SET PairingStatus = '"+str(status)+"' WHERE pid = '"+str(pid)+"';")
+    lee=round(time.time(),2)
+    q("UPDATE 'Pairings' SET PairingStatus = '"+str(status)+"', LastEditEpoch = "+str(lee)+" WHERE pid = '"+str(pid)+"';")
     if status=='PREVIOUS':
         resource=tdbGetTeamResourceByName(teamName)
         q("UPDATE 'Pairings' SET NameSave = '"+str(teamName)+"', ResourceSave = '"+str(resource)+"' WHERE pid = '"+str(pid)+"';")
     r=q("SELECT * FROM 'Pairings' WHERE pid = "+str(pid)+";")
     if r:
-        tdbUpdateLastEditEpoch(pid=pid)
+        boardRefresh('Pairings','pid',pid,r)
         validate=r[0]
-        tdbPushTables()
+        if push:
+            tdbPushTables()
         # logging.info("response in tdbSetPairingStatusByID:"+str(r))
         return {'validate':validate}
     else:
@@ -633,10 +1851,10 @@ def tdbSetPairingStatusByID(pid,status):
 def tdbSetTeamStatusByID(tid,status,push=True):
     if host:
         tdbAddHistoryEntry(tdbGetTeamNameByID(tid)+' -> '+status,tid=tid,recordedBy='SYSTEM')
-    q("UPDATE 'Teams' SET TeamStatus = '"+str(status)+"' WHERE tid = '"+str(tid)+"';")
+    q("UPDATE 'Teams' SET TeamStatus = '"+str(status)+"', LastEditEpoch = "+str(round(time.time(),2))+" WHERE tid = '"+str(tid)+"';")
     r=q("SELECT * FROM 'Teams' WHERE tid = "+str(tid)+";")
     if r:
-        tdbUpdateLastEditEpoch(tid=tid)
+        boardRefresh('Teams','tid',tid,r)
         validate=r[0]
         if push:
             tdbPushTables()
@@ -651,10 +1869,10 @@ def tdbSetTeamStatusByName(teamName,status,push=True):
 def tdbSetAssignmentStatusByID(aid,status,push=True):
     if host:
         tdbAddHistoryEntry(tdbGetAssignmentNameByID(aid)+' -> '+status,aid=aid,recordedBy='SYSTEM')
-    q("UPDATE 'Assignments' SET AssignmentStatus = '"+str(status)+"' WHERE aid = '"+str(aid)+"';")
+    q("UPDATE 'Assignments' SET AssignmentStatus = '"+str(status)+"', LastEditEpoch = "+str(round(time.time(),2))+" WHERE aid = '"+str(aid)+"';")
     r=q("SELECT * FROM 'Assignments' WHERE aid = "+str(aid)+";")
     if r:
-        tdbUpdateLastEditEpoch(aid=aid)
+        boardRefresh('Assignments','aid',aid,r)
         validate=r[0]
         if push:
             tdbPushTables()
@@ -669,10 +1887,10 @@ def tdbSetAssignmentStatusByName(assignmentName,status,push=True):
 def tdbSetAssignmentIntendedResourceByID(aid,intendedResource,push=True):
     if host:
         tdbAddHistoryEntry(tdbGetAssignmentNameByID(aid)+' -> '+intendedResource,aid=aid,recordedBy='SYSTEM')
-    q("UPDATE 'Assignments' SET IntendedResource = '"+str(intendedResource)+"' WHERE aid = '"+str(aid)+"';")
+    q("UPDATE 'Assignments' SET IntendedResource = '"+str(intendedResource)+"', LastEditEpoch = "+str(round(time.time(),2))+" WHERE aid = '"+str(aid)+"';")
     r=q("SELECT * FROM 'Assignments' WHERE aid = "+str(aid)+";")
     if r:
-        tdbUpdateLastEditEpoch(aid=aid)
+        boardRefresh('Assignments','aid',aid,r)
         validate=r[0]
         if push:
             tdbPushTables()
@@ -687,10 +1905,10 @@ def tdbSetAssignmentIntendedResourceByName(assignmentName,intendedResource,push=
 def tdbSetTeamResourceByID(tid,resource,push=True):
     if host:
         tdbAddHistoryEntry(tdbGetTeamNameByID(tid)+' -> '+resource,tid=tid,recordedBy='SYSTEM')
-    q("UPDATE 'Teams' SET Resource = '"+str(resource)+"' WHERE tid = '"+str(tid)+"';")
+    q("UPDATE 'Teams' SET Resource = '"+str(resource)+"', LastEditEpoch = "+str(round(time.time(),2))+" WHERE tid = '"+str(tid)+"';")
     r=q("SELECT * FROM 'Teams' WHERE tid = "+str(tid)+";")
     if r:
-        tdbUpdateLastEditEpoch(tid=tid)
+        boardRefresh('Teams','tid',tid,r)
         validate=r[0]
         if push:
             tdbPushTables()
@@ -705,10 +1923,10 @@ def tdbSetTeamResourceByName(teamName,resource,push=True):
 def tdbSetTeamMedicalByID(tid,medical,push=True):
     if host:
         tdbAddHistoryEntry(tdbGetTeamNameByID(tid)+' Medical -> '+medical,tid=tid,recordedBy='SYSTEM')
-    q("UPDATE 'Teams' SET Medical = '"+str(medical)+"' WHERE tid = '"+str(tid)+"';")
+    q("UPDATE 'Teams' SET Medical = '"+str(medical)+"', LastEditEpoch = "+str(round(time.time(),2))+" WHERE tid = '"+str(tid)+"';")
     r=q("SELECT * FROM 'Teams' WHERE tid = "+str(tid)+";")
     if r:
-        tdbUpdateLastEditEpoch(tid=tid)
+        boardRefresh('Teams','tid',tid,r)
         validate=r[0]
         if push:
             tdbPushTables()
@@ -725,6 +1943,7 @@ def tdbDeleteAssignment(aid,push=True):
         tdbAddHistoryEntry(tdbGetAssignmentNameByID(aid)+' DELETED',aid=aid,recordedBy='SYSTEM')
     q("DELETE FROM 'Assignments' WHERE aid = '"+str(aid)+"';")
     r=q("SELECT * FROM 'Assignments' WHERE aid = "+str(aid)+";") # should be empty
+    boardRefresh('Assignments','aid',aid,r)
     if r:
         validate=r[0]
         return {'validate':validate}
@@ -738,6 +1957,7 @@ def tdbDeleteTeam(tid,push=True):
         tdbAddHistoryEntry(tdbGetTeamNameByID(tid)+' DELETED',tid=tid,recordedBy='SYSTEM')
     q("DELETE FROM 'Teams' WHERE tid = '"+str(tid)+"';")
     r=q("SELECT * FROM 'Teams' WHERE tid = "+str(tid)+";") # should be empty
+    boardRefresh('Teams','tid',tid,r)
     if r:
         validate=r[0]
         return {'validate':validate}
@@ -754,31 +1974,35 @@ def tdbUpdateLastEditEpoch(tid=None,aid=None,pid=None):
     if tid:
         query="UPDATE 'Teams' SET LastEditEpoch = "+str(t)+" WHERE tid="+str(tid)+";"
         q(query)
+        boardRefresh('Teams','tid',tid)
     if aid:
         query="UPDATE 'Assignments' SET LastEditEpoch = "+str(t)+" WHERE aid="+str(aid)+";"
         q(query)
+        boardRefresh('Assignments','aid',aid)
     if pid:
         query="UPDATE 'Pairings' SET LastEditEpoch = "+str(t)+" WHERE pid="+str(pid)+";"
         q(query)
+        boardRefresh('Pairings','pid',pid)
 
 def tdbAddHistoryEntry(entry,hid=-1,aid=-1,tid=-1,recordedBy='N/A',epoch=None):
     # only the server can create original history entries; clients can only
     #  create local history entries during sync; hid and epoch arguments will
     #  only exist if this is being called from sync handler
-    if host:
-        global nextHid
-        hid=nextHid
-        nextHid+=1
-    else:
-        hid=hid or -1
-    epoch=epoch or round(time.time(),2)
-    r=qInsert('History',{
-        'hid':hid,
-        'aid':aid,
-        'tid':tid,
-        'Entry':entry,
-        'RecordedBy':recordedBy,
-        'Epoch':epoch})
+    with tdbBatch(): # one transaction for the new ID and the entry
+        if host:
+            hid=nextHostID('hid')
+        else:
+            hid=hid or -1
+        epoch=epoch or round(time.time(),2)
+        r=qInsert('History',{
+            'hid':hid,
+            'aid':aid,
+            'tid':tid,
+            'Entry':entry,
+            'RecordedBy':recordedBy,
+            'Epoch':epoch})
+        if host:
+            logChanges('History',[q('SELECT last_insert_rowid() AS n;')[0]['n']])
     return r
 
 def tdbGetPairingIDsByID(pid=None):
@@ -789,9 +2013,214 @@ def tdbGetPairingNamesByID(pid=None):
     r=tdbGetPairings(pid)[0]
     return [tdbGetAssignmentNameByID(r['aid']),tdbGetTeamNameByID(r['tid'])]
 
+#####################################
+## BATCH MUTATIONS
+#####################################
+## one user action on a client can mean several API requests (for example a
+##   repeat pairing sets the pairing, team, and assignment status); the client
+##   can send them all as one request instead:
+##     POST api/v1/batch  {'ops':[{'method':'PUT','url':'api/v1/teams/5/status','body':{'NewStatus':'ASSIGNED'}},...]}
+##   and the API handler just returns jsonify(tdbApplyBatch(ops)).  Each op is
+##   exactly the request that would otherwise have been sent on its own.  All
+##   ops run in one transaction, with one push and one change notification, and
+##   the response has one result per op, in order: the same {'validate':...}
+##   the single request would have returned.  If any op fails, the whole batch
+##   is rolled back, and every result is an error, so that a user action is
+##   never left half applied.
+
+# (method, url pattern, function(match,body)); url patterns are relative to api/v1/;
+#  tdbApplyBatch does the push, once, after all the ops
+BATCH_ROUTES=[
+    ('POST',r'teams/new',lambda m,b:tdbNewTeam(b['TeamName'],b['Resource'])),
+    ('POST',r'assignments/new',lambda m,b:tdbNewAssignment(b['AssignmentName'],b['IntendedResource'],sid=b.get('sid'))),
+    ('POST',r'pairings/new',lambda m,b:tdbNewPairing(int(b['aid']),int(b['tid']))),
+    ('PUT',r'pairings/(-?\d+)/status',lambda m,b:tdbSetPairingStatusByID(int(m[1]),b['NewStatus'],push=False)),
+    ('PUT',r'teams/(-?\d+)/status',lambda m,b:tdbSetTeamStatusByID(int(m[1]),b['NewStatus'],push=False)),
+    ('PUT',r'teams/(-?\d+)/resource',lambda m,b:tdbSetTeamResourceByID(int(m[1]),b['Resource'],push=False)),
+    ('PUT',r'teams/(-?\d+)/medical',lambda m,b:tdbSetTeamMedicalByID(int(m[1]),b['Medical'],push=False)),
+    ('PUT',r'teams/(-?\d+)/delete',lambda m,b:tdbDeleteTeam(int(m[1]),push=False)),
+    ('PUT',r'assignments/(-?\d+)/status',lambda m,b:tdbSetAssignmentStatusByID(int(m[1]),b['NewStatus'],push=False)),
+    ('PUT',r'assignments/(-?\d+)/intendedResource',lambda m,b:tdbSetAssignmentIntendedResourceByID(int(m[1]),b['IntendedResource'],push=False)),
+    ('PUT',r'assignments/(-?\d+)/delete',lambda m,b:tdbDeleteAssignment(int(m[1]),push=False))]
+
+class BatchError(Exception):
+    pass
+
+def batchOp(op):
+    method=str(op.get('method','')).upper()
+    url=str(op.get('url','')).strip('/')
+    if url.startswith('api/v1/'):
+        url=url[len('api/v1/'):]
+    for (routeMethod,pattern,f) in BATCH_ROUTES:
+        m=re.fullmatch(pattern,url)
+        if m and method==routeMethod:
+            try:
+                r=f(m,op.get('body') or {})
+            except (KeyError,ValueError,TypeError,IndexError) as e:
+                raise BatchError('bad request: '+str(e))
+            if 'error' in r:
+                raise BatchError(r['error'])
+            return r
+    raise BatchError('unknown batch operation '+method+' '+url)
+
+# tdbApplyBatch - apply a list of ops as one transaction; returns {'results':[...]},
+#  with one {'validate':...} per op, or one {'error':...} per op if the batch failed
+def tdbApplyBatch(ops):
+    results=[]
+    try:
+        with tdbBatch():
+            for (i,op) in enumerate(ops):
+                try:
+                    results.append(batchOp(op))
+                except (BatchError,sqlite3.Error) as e: # a failed statement raises inside the batch
+                    raise BatchError('op '+str(i)+': '+str(e))
+            tdbPushTables()
+    except (BatchError,sqlite3.Error) as e:
+        logging.warning('batch rolled back: '+str(e))
+        return {'results':[{'error':'batch rolled back: '+str(e)}]*len(ops)}
+    return {'results':results}
+
+#####################################
+## HISTORY ARCHIVE
+#####################################
+## history entries older than an operational period boundary can be moved
+##   out of the History table into HistoryArchive, so that the History table
+##   (and every query and sync that reads it) stays small as the incident goes
+##   on.  For each assignment/team combination, HistorySummary keeps the
+##   number of archived entries and their time range.  tdbGetHistory reads
+##   both tables unless archive=False, so the full record is still available.
+##   HistorySummary is a table of its own, next to History, rather than rows
+##   in History, so that summaries never show up as history entries.
+##   Archived entries are no longer part of the change feed, but the sequence
+##   number of the newest one is kept (Meta key HistoryArchivedSeq); a client
+##   whose sync starts before it (one that joins after the archive run) gets
+##   the archived entries in its sync too, so every tablet keeps the whole
+##   chain-of-custody record.
+
+HISTORY_ARCHIVE_AGE=12*3600 # seconds; default operational period boundary, relative to now
+
+# tdbArchiveHistory - move history entries with Epoch before the specified
+#  boundary (default: HISTORY_ARCHIVE_AGE seconds ago) to the archive; returns
+#  the number of entries archived
+def tdbArchiveHistory(before=None):
+    if before is None:
+        before=time.time()-HISTORY_ARCHIVE_AGE
+    with tdbBatch():
+        r=q("SELECT COUNT(*) AS count FROM 'History' WHERE Epoch < ?;",(before,))
+        count=r[0]['count'] if r else 0
+        if count:
+            q("INSERT INTO 'HistoryArchive' SELECT * FROM 'History' WHERE Epoch < ?;",(before,))
+            q('''INSERT INTO 'HistorySummary' (aid,tid,Entries,FirstEpoch,LastEpoch)
+                    SELECT aid,tid,COUNT(*),MIN(Epoch),MAX(Epoch) FROM 'History' WHERE Epoch < ? GROUP BY aid,tid
+                    ON CONFLICT(aid,tid) DO UPDATE SET
+                        Entries=Entries+excluded.Entries,
+                        FirstEpoch=MIN(FirstEpoch,excluded.FirstEpoch),
+                        LastEpoch=MAX(LastEpoch,excluded.LastEpoch);''',(before,))
+            # clients that synced from before this point need the archived entries too (see tdbGetChanges)
+            q('''INSERT INTO 'Meta' (Key,Value)
+                    SELECT 'HistoryArchivedSeq',MAX(seq) FROM 'ChangeLog'
+                    WHERE TableName='History' AND n IN (SELECT n FROM 'History' WHERE Epoch < ?) HAVING MAX(seq) IS NOT NULL
+                    ON CONFLICT(Key) DO UPDATE SET Value=MAX(Value,excluded.Value);''',(before,))
+            q("DELETE FROM 'ChangeLog' WHERE TableName='History' AND n IN (SELECT n FROM 'History' WHERE Epoch < ?);",(before,))
+            q("DELETE FROM 'History' WHERE Epoch < ?;",(before,))
+    logging.info('archived '+str(count)+' history entries older than '+str(before))
+    return count
+
+# tdbGetHistorySummary - archived entry counts and time ranges, for the
+#  specified assignment and/or team (either one), or for everything
+def tdbGetHistorySummary(aid=None,tid=None):
+    if aid and tid:
+        return q("SELECT * FROM 'HistorySummary' WHERE aid=? OR tid=?;",(aid,tid))
+    elif aid:
+        return q("SELECT * FROM 'HistorySummary' WHERE aid=?;",(aid,))
+    elif tid:
+        return q("SELECT * FROM 'HistorySummary' WHERE tid=?;",(tid,))
+    return q("SELECT * FROM 'HistorySummary';")
+
+#####################################
+## HISTORY SEARCH
+#####################################
+## full-text index of history entries, using sqlite's FTS5 extension.  The
+##   rowid of each HistorySearch row is the History n, which archived entries
+##   keep, so the index covers the History and HistoryArchive tables.
+##   Triggers on the History table keep it up to date, for entries added by
+##   tdbAddHistoryEntry and by the client sync handler alike; rows are not
+##   removed when entries are moved to the archive.
+## if this sqlite build does not include FTS5, tdbSearchHistory falls back to
+##   LIKE matching on the Entry column (slower, unranked)
+
+historySearchFTS=True # set to False by createHistorySearchTableIfNeeded if FTS5 is not available
+
+def createHistorySearchTableIfNeeded():
+    global historySearchFTS
+    exists=q("SELECT name FROM sqlite_master WHERE name='HistorySearch';")
+    if exists:
+        return
+    if q("CREATE VIRTUAL TABLE IF NOT EXISTS 'HistorySearch' USING fts5(Entry, RecordedBy, Epoch UNINDEXED);") is None:
+        logging.warning('sqlite FTS5 is not available; history search will not be indexed')
+        historySearchFTS=False
+        return
+    q('''CREATE TRIGGER IF NOT EXISTS "History_search_insert" AFTER INSERT ON "History" BEGIN
+            INSERT INTO 'HistorySearch' (rowid,Entry,RecordedBy,Epoch) VALUES (new.n,new.Entry,new.RecordedBy,new.Epoch);
+        END;''')
+    q('''CREATE TRIGGER IF NOT EXISTS "History_search_update" AFTER UPDATE OF Entry,RecordedBy,Epoch ON "History" BEGIN
+            UPDATE 'HistorySearch' SET Entry=new.Entry, RecordedBy=new.RecordedBy, Epoch=new.Epoch WHERE rowid=new.n;
+        END;''')
+    # index the entries of a database from a previous version
+    q('''INSERT INTO 'HistorySearch' (rowid,Entry,RecordedBy,Epoch)
+            SELECT n,Entry,RecordedBy,Epoch FROM 'History' UNION ALL SELECT n,Entry,RecordedBy,Epoch FROM 'HistoryArchive';''')
+
+# the words of a search, as an FTS5 query that matches entries containing all
+#  of them, each as a prefix; quoting each word means that punctuation typed
+#  in the search box (e.g. '+' or '->') can't cause a query syntax error
+def historySearchQuery(text):
+    return ' '.join(['"'+word+'"*' for word in re.findall(r'\w+',text)])
+
+# tdbSearchHistory - return up to limit history entries (from History and
+#  HistoryArchive) that contain all words of query, best match first; since
+#  and until optionally restrict the results to a range of Epoch values.
+#  Each returned entry also has a 'rank' key (lower is better).
+def tdbSearchHistory(query,limit=50,since=None,until=None):
+    words=re.findall(r'\w+',query)
+    if not words:
+        return []
+    timeCondition=''
+    params=[]
+    if since is not None:
+        timeCondition+=' AND Epoch >= ?'
+        params.append(since)
+    if until is not None:
+        timeCondition+=' AND Epoch <= ?'
+        params.append(until)
+    if historySearchFTS:
+        matches=q("SELECT rowid AS n, rank FROM 'HistorySearch' WHERE HistorySearch MATCH ?"+timeCondition+" ORDER BY rank LIMIT ?;",
+                [historySearchQuery(query)]+params+[int(limit)]) or []
+        if not matches:
+            return []
+        ranks={x['n']:x['rank'] for x in matches}
+        marks=','.join(['?']*len(ranks))
+        rows=q("SELECT * FROM 'History' WHERE n IN ("+marks+") UNION ALL SELECT * FROM 'HistoryArchive' WHERE n IN ("+marks+");",
+                list(ranks)*2) or []
+        for row in rows:
+            row['rank']=ranks[row['n']]
+        return sorted(rows,key=lambda row:(row['rank'],-row['n']))
+    condition=' AND '.join(["Entry LIKE ?"]*len(words))+timeCondition
+    params=['%'+word+'%' for word in words]+params
+    rows=q("SELECT * FROM 'History' WHERE "+condition+" UNION ALL SELECT * FROM 'HistoryArchive' WHERE "+condition+" ORDER BY n DESC LIMIT ?;",
+            params+params+[int(limit)]) or []
+    for row in rows:
+        row['rank']=0
+    return rows
+
 # tdbGetHistory with no arguments will return the entire history table
 # tdbGetHistory(since=123) will return all entries with Epoch greater than 123
-def tdbGetHistory(aid=None,tid=None,pid=None,useAnd=None,since=0):
+# pagination: if limit, beforeN or afterN is specified, entries are returned
+#  newest first (by the local index n, i.e. the order they were recorded here),
+#  up to limit entries; beforeN / afterN are keyset cursors: pass the n of the
+#  last entry of the previous page as beforeN to get the next (older) page, or
+#  the n of the newest entry already shown as afterN to get only newer entries
+# archived entries are included, unless archive=False
+def tdbGetHistory(aid=None,tid=None,pid=None,useAnd=None,since=0,limit=None,beforeN=None,afterN=None,archive=True):
     op='OR' # by default, return history entries that involve either the team or the assignment
     if useAnd:
         op='AND' # optionally return history entries that only affect the status of both team and assignment
@@ -809,14 +2238,29 @@ def tdbGetHistory(aid=None,tid=None,pid=None,useAnd=None,since=0):
         if tid:
             conditionT='tid='+str(tid)
         if aid and tid:
-            condition=conditionA+' '+op+' '+conditionT
+            condition='('+conditionA+' '+op+' '+conditionT+')'
         elif aid:
             condition=conditionA
         else:
             condition=conditionT
         if since:
             condition+=' AND Epoch > '+str(since)
-    query="SELECT * FROM 'History' WHERE {condition};".format(
-            condition=condition)
+    order=''
+    if limit is not None or beforeN is not None or afterN is not None:
+        if beforeN is not None:
+            condition+=' AND n < '+str(int(beforeN))
+        if afterN is not None:
+            condition+=' AND n > '+str(int(afterN))
+        order=' ORDER BY n DESC'
+        if limit is not None:
+            order+=' LIMIT '+str(int(limit))
+    if archive:
+        query="SELECT * FROM 'History' WHERE {condition} UNION ALL SELECT * FROM 'HistoryArchive' WHERE {condition}{order};"
+        if not order:
+            order=' ORDER BY n' # same order as History alone: archived entries are older
+    else:
+        query="SELECT * FROM 'History' WHERE {condition}{order};"
+    query=query.format(
+            condition=condition,
+            order=order)
     return q(query)
-
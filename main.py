@@ -42,6 +42,11 @@ from datetime import datetime,timezone
 # import requests
 # from requests.exceptions import Timeout
 import json
+import difflib
+import contextlib
+import types
+import threading
+import random
 from functools import partial
 import configparser
 import urllib.parse
@@ -49,6 +54,7 @@ import certifi # attempt to fix SSL shared-token problem on Android
 # from plyer import wifi
 # import pusher
 from sartopo_python import SartopoSession
+from websocket import create_connection, WebSocketTimeoutException
 
 # # database interface module shared by this app and the assignmentTracker_api
 from assignmentTracker_db import *
@@ -80,7 +86,7 @@ from kivy.utils import platform
 from kivy.core.window import Window
 
 # custom version of kivy/network/urlrequest.py to allow synchronous (blocking) requests
-from urlrequest_tmg import UrlRequest
+from urlrequest_tmg import UrlRequest, get_pool_stats, get_lane_stats, LANE_USER, LANE_SYNC, LANE_BACKGROUND
 
 from kivy.logger import Logger
 
@@ -147,6 +153,27 @@ COMPLETED_PAIRING_POPUP_TEXT='''
     2. Delete related medical marker, if any
     3. Deliver paper 104 to RESU'''
 
+HISTORY_PAGE_SIZE=50 # activity log entries loaded at a time on the pairing detail screen
+
+# while the change listener is connected, the host says when to sync, and
+#  polling is only a safety net in case a notification was missed
+SYNC_SAFETY_INTERVAL=60 # seconds
+# otherwise, poll every SYNC_INTERVAL_MIN seconds while syncs are bringing
+#  changes, doubling the interval after each empty sync up to SYNC_INTERVAL_MAX
+SYNC_INTERVAL_MIN=1 # seconds
+SYNC_INTERVAL_MAX=30
+# after a failed sync, retry after SYNC_RETRY_MIN seconds, doubling after each
+#  further failure up to SYNC_RETRY_MAX, +/- 50% so tablets don't retry in step
+SYNC_RETRY_MIN=2 # seconds
+SYNC_RETRY_MAX=60
+CHANGE_LISTENER_PING=30 # seconds without any message before checking the connection
+IN_FLIGHT_MAX_AGE=60 # seconds; an unanswered GET is presumed lost after this long
+# completion policies for a request sent to more than one host (see FanOut)
+FANOUT_FIRST='first' # done as soon as any host succeeds
+FANOUT_ALL='all' # done when every host has succeeded
+FANOUT_QUORUM='quorum' # done when more than half of the hosts have succeeded
+FANOUT_POLL=0.05 # seconds between checks while a blocking request waits for its hosts
+
 ROLES=[
     'SITUATION UNIT',
     'RESOURCE UNIT',
@@ -172,13 +199,41 @@ class assignmentTrackerApp(App):
         self.defaultTextHeightMultiplier=0.7
         self.gui=Builder.load_file('main.kv')
         self.teamsList=[]
+        self.counts=None # counts shown on the view switcher buttons
+        self.rvKeys={} # RecycleView id : keys of the rows it is showing, in order
         self.assignentsList=[]
         self.sm=ScreenManager()
         self.pairingDetailBeingShown=[]
         self.pairingHistoryRVList=[1,2,3,4,5]
+        self.historyShown=None # [assignmentName,teamName] whose activity log is loaded
+        self.historyNewestN=None # History n of the newest entry shown
+        self.historyOldestN=None # History n of the oldest entry shown
+        self.historyAllLoaded=False
+        self.historySearchActive=False # the activity log is showing search results
         self.apiOKText="<h1>AssignmentTracker Database API</h1>"
         self.lastSyncTimeStamp=0
-        self.syncInterval=5
+        self.lastSyncSeq=0 # host change feed sequence number of the last sync
+        self.syncChangeFeed=True # sync from api/v1/changes; False for a host that only has api/v1/since
+        self.syncIncident=None # host incident database ID from the last sync
+        self.syncHost=None # [name,server] of the host that the sync cursor above belongs to
+        self.syncInterval=5 # seconds until the first sync after joining
+        self.syncDelay=self.syncInterval # current adaptive sync interval
+        self.syncFailures=0 # consecutive failed syncs
+        self.syncTimer=None # Clock event for the next sync
+        self.etags={} # url : ETag of the last response, for conditional GETs
+        self.notModifiedCount=0 # '304 Not Modified' responses received
+        self.keepAlive=True # reuse persistent http connections to the host(s) (see urlrequest_tmg)
+        self.inFlight={} # url, or (LANE_SYNC,host) : [time sent, [callbacks of each request waiting for that GET]]
+        self.coalescedCount=0 # GETs answered by a request that was already in flight
+        self.syncSkippedCount=0 # syncs not sent because one was in flight to the same host
+        self.batchOps=None # [op,kwargs] of each request gathered by requestBatch, while one is open
+        self.batchedCount=0 # requests sent as part of an api/v1/batch request
+        self.fanoutPolicy=FANOUT_FIRST # default completion policy when sending to more than one host
+        self.hostStats={} # host name : latency and failure counts (see recordHostResult)
+        self.changeListener=None # ChangeListener, while syncing
+        self.syncRequestTime=0 # time.time() of the last sync request
+        self.syncInFlight=False # a sync request has been sent and not answered yet
+        self.syncAgain=False # something changed while a sync was in flight
         self.resourceTypes=[ # matches sartopo assignment resource choices
             'GROUND',
             'GROUND-1',
@@ -471,7 +526,7 @@ class assignmentTrackerApp(App):
                 self.setSts()
                 self.stsSync()
             self.sync(since=0)
-            self.syncTimer=Clock.schedule_interval(self.sync,self.syncInterval) # start syncing every 5 seconds
+            self.startSync()
 
     def lanJoin(self,init=False):
         if self.lan:
@@ -573,14 +628,29 @@ class assignmentTrackerApp(App):
 #  - you will probably want to specify one or more custom callbacks
 #     with the on_success/failure/response arguments; default callbacks
 #     will be used for whichever callback arguments are not specified
+    # useETag: for asynchronous GETs; send the ETag of the previous response from
+    #  the same url as If-None-Match, and if the host answers '304 Not Modified',
+    #  call on_not_modified(request,result) instead of on_success (there is no body)
+    # lane: LANE_USER, LANE_SYNC or LANE_BACKGROUND; while requests are waiting
+    #  to be sent, user changes go first, then syncs, then everything else.
+    #  Default: LANE_USER for changes (PUT/POST), LANE_BACKGROUND for GETs.
+    #  An asynchronous GET for a url that is already in flight is not sent again;
+    #  its callbacks are called with the response of the one in flight.  Only
+    #  one sync per host is in flight at a time; the app's sync() follows up
+    #  on any sync that is skipped (see syncAgain).
     def request(self,host="",urlEnd="",method="GET",body=None,
             timeout=None,
             on_success=None,
             on_failure=None,
-            on_error=None):
+            on_error=None,
+            useETag=False,
+            on_not_modified=None,
+            lane=None,
+            block=True):
         on_success=on_success or self.request_callback
         on_failure=on_failure or self.request_callback
         on_error=on_error or self.request_callback
+        on_redirect=None
         if timeout: # don't use callbacks if this a synchronous request
             on_success=None
             on_failure=None
@@ -590,30 +660,106 @@ class assignmentTrackerApp(App):
         url=host+urlEnd
         if type(body) is dict:
             body=json.dumps(body)
-        if 'since' not in url: # don't show sync requests - too verbose
+        if 'api/v1/changes' not in url: # don't show sync requests - too verbose
             Logger.info("request: "+str(url)+" "+str(method)+" body="+str(body)+" timeout="+str(timeout))
         headers={}
         headers['Authorization']='Bearer '+self.tracker_api_key
         if body:
             headers['Content-type']='application/json'
             headers['Accept']='text/plain'
+        if useETag and method=='GET' and not timeout:
+            if url in self.etags:
+                headers['If-None-Match']=self.etags[url]
+            on_success=self.etagSuccess(url,on_success)
+            on_redirect=self.etagNotModified(on_not_modified)
+        if lane is None:
+            lane=LANE_BACKGROUND if method=='GET' else LANE_USER
+        if method=='GET' and not timeout:
+            key=(LANE_SYNC,host) if lane==LANE_SYNC else url
+            # a request with no answer after IN_FLIGHT_MAX_AGE is presumed lost
+            if key in self.inFlight and time.time()-self.inFlight[key][0]<IN_FLIGHT_MAX_AGE:
+                if lane==LANE_SYNC:
+                    self.syncSkippedCount+=1
+                else:
+                    self.inFlight[key][1].append([on_success,on_redirect,on_failure,on_error])
+                    self.coalescedCount+=1
+                return 'Asynchronous request has been sent.'
+            sent=time.time()
+            self.inFlight[key]=[sent,[[on_success,on_redirect,on_failure,on_error]]]
+            [on_success,on_redirect,on_failure,on_error]=[self.inFlightDone(key,sent,i) for i in range(4)]
         req=UrlRequest(url,
                 # on_success=self.on_request_success,
                 # on_failure=self.on_request_failure,
                 # on_error=self.on_request_error,
                 on_success=on_success,
+                on_redirect=on_redirect,
                 on_failure=on_failure,
                 on_error=on_error,
                 req_headers=headers,
                 req_body=body,
                 timeout=timeout,
                 method=method,
+                keep_alive=self.keepAlive,
+                priority=lane,
+                block=block and timeout is not None,
                 debug=True)
+        if timeout and not block: # the caller will wait for it
+            return req
         if timeout: # synchronous request; return the response
             return req.result
         else: # asynchronous request; return the request
             return 'Asynchronous request has been sent.'
 
+    # inFlightDone - callback for an in-flight GET: pass the response to the
+    #  callback i (on_success, on_redirect, on_failure, on_error) of each request
+    #  that is waiting for it
+    def inFlightDone(self,key,sent,i):
+        def f(request,result):
+            if key not in self.inFlight or self.inFlight[key][0]!=sent:
+                return # presumed lost; a newer request has taken its place
+            for callbacks in self.inFlight.pop(key)[1]:
+                if callbacks[i]:
+                    callbacks[i](request,result)
+        return f
+
+    # getRequestStats - connections made and reused, 304 responses received,
+    #  GETs coalesced or skipped, requests sent in batches, queue wait times for
+    #  each lane, and latency and failures for each host
+    def getRequestStats(self):
+        d=get_pool_stats()
+        d['notModified']=self.notModifiedCount
+        d['coalesced']=self.coalescedCount
+        d['syncSkipped']=self.syncSkippedCount
+        d['batched']=self.batchedCount
+        d['hosts']=self.getHostStats()
+        d['lanes']=get_lane_stats()
+        return d
+
+    def on_stop(self):
+        Logger.info("request stats: "+str(self.getRequestStats()))
+
+    # etagSuccess - on_success wrapper that remembers the ETag of the response
+    def etagSuccess(self,url,on_success):
+        def f(request,result):
+            etag=[v for (k,v) in (request.resp_headers or {}).items() if k.lower()=='etag']
+            if etag:
+                if len(self.etags)>100: # the sync url changes with each new sequence number
+                    self.etags.clear()
+                self.etags[url]=etag[0]
+            on_success(request,result)
+        return f
+
+    # etagNotModified - on_redirect handler for '304 Not Modified'
+    def etagNotModified(self,on_not_modified):
+        def f(request,result):
+            if request.resp_status==304:
+                self.notModifiedCount+=1
+                if on_not_modified:
+                    on_not_modified(request,result)
+            else:
+                Logger.info("unexpected redirect response "+str(request.resp_status)+" from "+str(request.url))
+        return f
+
     # def on_request_success(self,request,result):
     def request_callback(self,request,result):
         headerStr=str(request.req_headers)
@@ -635,21 +781,126 @@ class assignmentTrackerApp(App):
         return self.request(self.localhostServer,urlEnd,method,body,**kwargs)
 
     # this is the function that will be used most often:
-    # if GET, send request only to primary server;
+    # if GET, send request only to primary server (each host has its own change
+    #  feed sequence numbers and incident ID, so reads can't be mixed);
     # otherwise, send request to all servers in use
-    def sendRequest(self,urlEnd="",method="GET",body=None,**kwargs):
-        r=None
+    # policy: FANOUT_FIRST, FANOUT_ALL or FANOUT_QUORUM, when more than one host
+    #  is active; the default is self.fanoutPolicy
+    def sendRequest(self,urlEnd="",method="GET",body=None,policy=None,**kwargs):
+        if self.batchOps is not None and method in ['PUT','POST'] and not kwargs.get('timeout'):
+            self.batchOps.append([{'method':method,'url':urlEnd,'body':body or {}},dict(kwargs,policy=policy)])
+            return 'Request has been added to the batch.'
+        hosts=self.getActiveHosts()
+        if not hosts:
+            return None
+        if method in ['GET','HEAD']:
+            hosts=hosts[:1]
+        return FanOut(self,hosts,policy or self.fanoutPolicy,kwargs).send(urlEnd,method,body)
+
+    # getActiveHosts - [name,server] of each host that requests are sent to, in
+    #  order of preference; with more than one, the response from the first
+    #  one that succeeded is the one passed on
+    def getActiveHosts(self):
+        hosts=[]
         if self.lan:
-            r=self.lanRequest(urlEnd,method,body,**kwargs)
+            hosts.append(['lan',self.lanServer])
         if self.cloud:
-            r=self.cloudRequest(urlEnd,method,body,**kwargs)
+            hosts.append(['cloud',self.cloudServer])
         if self.localhost:
-            r=self.localhostRequest(urlEnd,method,body,**kwargs)
-        return r
+            hosts.append(['localhost',self.localhostServer])
+        return hosts
+
+    # recordHostResult - keep latency and failure counts for each host
+    def recordHostResult(self,name,ok,ms,error=None):
+        d=self.hostStats.setdefault(name,{'requests':0,'failures':0,'consecutiveFailures':0,'lastMs':None,'avgMs':None,'lastError':None})
+        d['requests']+=1
+        d['lastMs']=ms
+        d['avgMs']=ms if d['avgMs'] is None else round(0.8*d['avgMs']+0.2*ms,1)
+        if ok:
+            d['consecutiveFailures']=0
+        else:
+            d['failures']+=1
+            d['consecutiveFailures']+=1
+            d['lastError']=str(error)
+
+    def getHostStats(self):
+        return {name:dict(d) for (name,d) in self.hostStats.items()}
+
+    # showHostStats - the connection icon shows the latency and failures of each host
+    def showHostStats(self,*args):
+        lines=[]
+        for [name,server] in self.getActiveHosts():
+            d=self.hostStats.get(name)
+            if d:
+                lines.append(name+': '+str(d['requests'])+' requests, '+str(d['failures'])+' failed'+
+                        '\n    last '+str(d['lastMs'])+' ms, average '+str(d['avgMs'])+' ms'+
+                        ('\n    last error: '+d['lastError'] if d['consecutiveFailures'] else ''))
+            else:
+                lines.append(name+': no requests yet')
+        self.textpopup(title='Connections',text='\n'.join(lines) or 'No hosts')
+
+    # requestBatch - gather the PUT and POST requests of one user action:
+    #    with self.requestBatch():
+    #        self.sendRequest(...)
+    #        self.sendRequest(...)
+    #  they are sent as one api/v1/batch request when the block ends, which the
+    #  host applies in one transaction with one push (see tdbApplyBatch); each
+    #  request's own on_success is still called, with its own result.  Nothing
+    #  is sent if the block raises an exception.
+    @contextlib.contextmanager
+    def requestBatch(self):
+        if self.batchOps is not None: # nested; the outermost batch sends
+            yield
+            return
+        self.batchOps=[]
+        try:
+            yield
+        finally:
+            ops=self.batchOps
+            self.batchOps=None
+        self.sendBatch(ops)
+
+    def sendBatch(self,ops):
+        if len(ops)==1: # no need for a batch
+            [op,kwargs]=ops[0]
+            self.sendRequest(op['url'],op['method'],op['body'],**kwargs)
+        elif ops:
+            self.batchedCount+=len(ops)
+            self.sendRequest('api/v1/batch','POST',{'ops':[op for [op,kwargs] in ops]},
+                    on_success=partial(self.on_batch_success,ops),
+                    on_host_failure=partial(self.batchHostFallback,ops))
+
+    # on_batch_success - pass each op's result to the on_success of the request
+    #  it came from, as though it had been sent on its own; the handlers only
+    #  look at req_body and url of the request
+    def on_batch_success(self,ops,request,response):
+        results=(response.get('results') or []) if type(response) is dict else []
+        for ([op,kwargs],result) in zip(ops,results):
+            if 'error' in result:
+                Logger.warning('batch request '+str(op['method'])+' '+str(op['url'])+' failed: '+str(result['error']))
+            elif kwargs.get('on_success'):
+                opRequest=types.SimpleNamespace(url=op['url'],req_body=json.dumps(op['body']),resp_status=request.resp_status)
+                kwargs['on_success'](opRequest,result)
+
+    # batchHostFallback - a host that doesn't know api/v1/batch answers 404 or 405;
+    #  send that host the requests one at a time instead.  Runs for each host
+    #  that fails, whether or not the batch has already succeeded on another host
+    def batchHostFallback(self,ops,server,request,result):
+        if request.resp_status not in [404,405]:
+            return False
+        Logger.info(str(server)+' does not accept batch requests; sending '+str(len(ops))+' requests separately')
+        for [op,kwargs] in ops:
+            kwargs={k:v for (k,v) in kwargs.items() if k!='policy'}
+            self.request(server,op['url'],op['method'],op['body'],**kwargs)
+        return True
 
     def getAPIKeys(self):
         self.tracker_api_key="NONE"
+        self.pusherKey=None # pusher.com key and cluster, to hear about changes on the cloud host
+        self.pusherCluster=None
         if platform in ('windows'):
+            self.pusherKey=os.getenv('TRACKER_PUSHER_KEY')
+            self.pusherCluster=os.getenv('TRACKER_PUSHER_CLUSTER')
             self.tracker_api_key=os.getenv('TRACKER_API_KEY')
             if self.tracker_api_key==None:
                 self.tracker_api_key="NONE"
@@ -664,6 +915,8 @@ class assignmentTrackerApp(App):
             with open('./keys.json','r',errors='ignore') as keyFile:
                 data=json.load(keyFile)
                 self.tracker_api_key=data["tracker_api_key"]
+                self.pusherKey=data.get("tracker_pusher_key")
+                self.pusherCluster=data.get("tracker_pusher_cluster")
 
     def checkForLAN(self):
         print("calling checkForLAN")
@@ -703,105 +956,161 @@ class assignmentTrackerApp(App):
                     Logger.info("SSID line found:"+line)
                     self.ssid=line.split(': ')[1]
     
+    # startSync - listen for change notifications from the host, and start the
+    #  adaptive sync timer (see scheduleNextSync)
+    def startSync(self):
+        if self.lan:
+            url='ws://'+re.sub(r'^.*://|:.*$','',self.lanServer)+':80'
+            self.changeListener=ChangeListener(url,self.on_changes)
+        elif self.cloud and self.pusherKey and self.pusherCluster:
+            url='wss://ws-'+self.pusherCluster+'.pusher.com/app/'+self.pusherKey+'?protocol=7&client=python&version=1.0'
+            self.changeListener=ChangeListener(url,self.on_changes,pusherChannel='my-channel')
+        elif self.localhost:
+            self.changeListener=ChangeListener('ws://127.0.0.1:80',self.on_changes)
+        self.scheduleSync(self.syncDelay)
+
+    def scheduleSync(self,delay):
+        if self.syncTimer:
+            self.syncTimer.cancel()
+        self.syncTimer=Clock.schedule_once(self.syncTick,delay)
+
+    def syncTick(self,*args):
+        # in case this request never gets an answer; normally the answer
+        #  reschedules (scheduleNextSync or on_sync_failure)
+        self.scheduleSync(max(self.syncDelay,SYNC_RETRY_MAX))
+        self.sync()
+
+    # scheduleNextSync - after a successful sync: sync every SYNC_SAFETY_INTERVAL
+    #  seconds while the change listener is connected; otherwise, sync quickly
+    #  while there is activity, and back off while there is none, so that idle
+    #  tablets cost the server very little
+    def scheduleNextSync(self,active):
+        if self.syncFailures:
+            Logger.info("sync recovered after "+str(self.syncFailures)+" failed attempt(s)")
+            self.syncFailures=0
+            self.showConnDegraded(False)
+        if self.changeListener and self.changeListener.isConnected():
+            self.syncDelay=SYNC_SAFETY_INTERVAL
+        elif active:
+            self.syncDelay=SYNC_INTERVAL_MIN
+        else:
+            self.syncDelay=min(max(self.syncDelay,SYNC_INTERVAL_MIN)*2,SYNC_INTERVAL_MAX)
+        self.scheduleSync(self.syncDelay)
+
+    # showConnDegraded - show the faded connection icon while syncs are failing
+    def showConnDegraded(self,degraded):
+        src=self.connIconSrc
+        if degraded:
+            src=src.replace('.png','_faded.png')
+        self.teamsScreen.ids.deviceHeader.ids.connButton.background_normal=src
+        self.assignmentsScreen.ids.deviceHeader.ids.connButton.background_normal=src
+
+    # on_changes - change notification from the host; sync if we don't have it yet
+    def on_changes(self,msg,*args):
+        if msg.get('seq',0)>self.lastSyncSeq or msg.get('incident')!=self.syncIncident:
+            self.sync()
+
+    # sync: get everything that changed on the host after the last change feed
+    #  sequence number we received (the host API returns tdbGetChanges(since))
     def sync(self,*args,since=None):
-        since=since or self.lastSyncTimeStamp
-        # Logger.info("sync called: lastSyncTimeStamp="+str(since))
-        self.sendRequest("api/v1/since/"+str(int(since)),on_success=self.on_sync_success,on_failure=self.on_sync_failure,on_error=self.on_sync_failure)
+        if self.syncInFlight and time.time()-self.syncRequestTime<30:
+            self.syncAgain=True # sync again when this one is done, from its new sequence number
+            return
+        hosts=self.getActiveHosts()
+        if not hosts:
+            return
+        if hosts[0]!=self.syncHost:
+            self.setSyncHost(hosts[0])
+            since=None
+        self.syncInFlight=True
+        self.syncRequestTime=time.time()
+        if self.syncChangeFeed:
+            if since is None:
+                since=self.lastSyncSeq
+            api="api/v1/changes/"+str(int(since))
+        else: # a host without the change feed; get rows edited after the last sync time
+            if since is None:
+                since=self.lastSyncTimeStamp
+            api="api/v1/since/"+str(int(since))
+        # Logger.info("sync called: since="+str(since))
+        self.sendRequest(api,on_success=self.on_sync_success,on_failure=self.on_sync_failure,on_error=self.on_sync_failure,
+                useETag=True,on_not_modified=self.on_sync_not_modified,lane=LANE_SYNC)
+
+    # setSyncHost - the sync cursor (lastSyncSeq, lastSyncTimeStamp, syncIncident)
+    #  only means something to the host it came from; when the primary host
+    #  changes, start on the new host's change feed from the beginning.  Rows
+    #  already here are kept and updated by that sync, like a new client's.
+    def setSyncHost(self,host):
+        if self.syncHost:
+            Logger.info("syncing from "+str(host[0])+" instead of "+str(self.syncHost[0])+"; starting on its change feed from the beginning")
+        self.syncHost=host
+        self.lastSyncSeq=0
+        self.lastSyncTimeStamp=0
+        self.syncIncident=None
+        self.syncChangeFeed=True
+
+    # isSyncHostAnswer - the sync was answered by the current sync host, not by
+    #  one that was the primary host when the request was sent
+    def isSyncHostAnswer(self,request):
+        return self.syncHost is not None and str(getattr(request,'url','')).startswith(self.syncHost[1])
+
+    # syncDone - a sync request was answered; active: it brought changes
+    def syncDone(self,active):
+        self.syncInFlight=False
+        if self.syncAgain: # runs after this result has been applied
+            self.syncAgain=False
+            Clock.schedule_once(self.sync)
+        self.scheduleNextSync(active)
+
+    # on_sync_not_modified - '304 Not Modified': nothing changed since the last sync
+    def on_sync_not_modified(self,request,result):
+        self.syncDone(False)
 
     def on_sync_success(self,request,result):
         # Logger.info("  on_sync_success called:"+str(result))
+        if not self.isSyncHostAnswer(request):
+            self.syncAgain=True # from the new sync host
+            self.syncDone(False)
+            return None
+        self.syncDone(any(result.get(key) for key in ['Teams','Assignments','Pairings','History']))
+        incident=result.get('incident',None)
+        if self.syncIncident and incident!=self.syncIncident:
+            # the host database was re-initialized, so our sequence number means
+            #  nothing there; a host that restarted and resumed keeps its incident ID
+            Logger.info("host incident ID changed from "+str(self.syncIncident)+" to "+str(incident)+"; clearing the local database and syncing from the beginning")
+            self.syncIncident=incident
+            self.resetIncident()
+            Clock.schedule_once(partial(self.sync,since=0))
+            return None
+        self.syncIncident=incident
+        lastSyncTimeStamp=self.lastSyncTimeStamp
         self.lastSyncTimeStamp=float(result['timestamp'])
-        # Logger.info("  lastSyncTimeStamp is now "+str(self.lastSyncTimeStamp))
+        lastSyncSeq=self.lastSyncSeq
+        self.lastSyncSeq=int(result.get('seq',lastSyncSeq)) # no seq from an api/v1/since sync
+        # Logger.info("  lastSyncSeq is now "+str(self.lastSyncSeq))
         requiredKeys=['Teams','Assignments','Pairings','History']
         if not all(key in result.keys() for key in requiredKeys):
             Logger.info("ERROR: sync result does not contain all required keys:"+str(requiredKeys))
             return None
-        # if the new/updated host entry already exists local entry,
+        # if the new/updated host entry already exists as a local entry,
         #  update the values of the local entry (e.g. status, resource, timestamp);
-        # otherwise, add it as a new local entry (a different client created it)
+        # otherwise, add it as a new local entry (a different client created it);
+        # the whole sync result is applied in one transaction
+        r=tdbApplySync(result)
+        if r is None:
+            self.lastSyncSeq=lastSyncSeq # ask for the same changes again next time
+            self.lastSyncTimeStamp=lastSyncTimeStamp
+            self.etags.pop(request.url,None) # and don't let the host answer 'not modified'
+            Logger.info("ERROR: sync result could not be applied; will retry from seq "+str(self.lastSyncSeq))
+            return None
+        if r['Teams'] or r['Assignments'] or r['Pairings'] or r['History']:
+            Logger.info("sync seq "+str(self.lastSyncSeq)+": applied "+str(r['Teams'])+" teams, "+str(r['Assignments'])+" assignments, "+str(r['Pairings'])+" pairings, "+str(r['History'])+" history entries in "+str(r['ms'])+"ms")
         for e in result['Teams']:
-            # fields to update: TeamStatus, Resource, LastEditEpoch
-            #  (TeamName can never be changed)
-            setString="TeamStatus='"+str(e['TeamStatus'])+"'"
-            setString+=", Resource='"+str(e['Resource'])+"'"
-            setString+=", Medical='"+str(e['Medical'])+"'"
-            setString+=', LastEditEpoch='+str(e['LastEditEpoch'])
-            query='UPDATE Teams SET '+setString+' WHERE tid='+str(e['tid'])+';'
-            Logger.info('Teams sync query:'+query)
-            r=q(query) # return value is number of rows affected
-            Logger.info('  response='+str(r))
-            if r==0:
-                r=tdbNewTeam(
-                        e['TeamName'],
-                        e['Resource'],
-                        status=e['TeamStatus'],
-                        medical=e['Medical'],
-                        tid=e['tid'],
-                        lastEditEpoch=e['LastEditEpoch'])
-                Logger.info('   creating a new team.  response:'+str(r))
             if e['TeamName'] in self.teamNamePool:
                 self.teamNamePool.remove(e['TeamName'])
         for e in result['Assignments']:
-            # fields to update: AssignmentStatus, IntendedResource, LastEditEpoch
-            #  (AssignmentName can never be changed)
-            setString="AssignmentStatus='"+str(e['AssignmentStatus'])+"'"
-            setString+=", IntendedResource='"+str(e['IntendedResource'])+"'"
-            setString+=", sid='"+str(e['sid'])+"'"
-            setString+=', LastEditEpoch='+str(e['LastEditEpoch'])
-            query='UPDATE Assignments SET '+setString+' WHERE aid='+str(e['aid'])+';'
-            Logger.info('Assignment sync query:'+query)
-            r=q(query) # return value is number of rows affected
-            Logger.info('  response='+str(r))
-            if r==0:
-                r=tdbNewAssignment(
-                        e['AssignmentName'],
-                        e['IntendedResource'],
-                        status=e['AssignmentStatus'],
-                        aid=e['aid'],
-                        sid=e['sid'],
-                        lastEditEpoch=e['LastEditEpoch'])
-                Logger.info('   creating a new assignment.  response:'+str(r))
             if e['AssignmentName'] in self.assignmentNamePool:
                 self.assignmentNamePool.remove(e['AssignmentName'])
-        for e in result['Pairings']:
-            # fields to update: PairingStatus, LastEditEpoch
-            #  (tid, aid can never be changed)
-            setString="PairingStatus='"+str(e['PairingStatus'])+"'"
-            setString+=', LastEditEpoch='+str(e['LastEditEpoch'])
-            query='UPDATE Pairings SET '+setString+' WHERE pid='+str(e['pid'])+';'
-            Logger.info('Pairing sync query:'+query)
-            r=q(query) # return value is number of rows affected
-            Logger.info('  response='+str(r))
-            if r==0:
-                # tdbNewPairing will normally set the team and assignment
-                #  statuses to 'ASSIGNED' but if this is joining an already-in-progress
-                #  pairing then the team status (WORKING, ENROUTE TO IC, DEBRIEFING)
-                #  should be preserved
-                r=tdbNewPairing(
-                        e['aid'],
-                        e['tid'],
-                        status=e['PairingStatus'],
-                        pid=e['pid'],
-                        # teamStatus=tdbGetTeamStatusByName(tdbGetTeamNameByID(tid)),
-                        lastEditEpoch=e['LastEditEpoch'])
-                Logger.info('   creating a new pairing.  response:'+str(r))
-        for e in result['History']:
-            # fields to update: Epoch
-            #  (tid, aid, Entry can never be changed)
-            setString="Epoch='"+str(e['Epoch'])+"'"
-            query='UPDATE History SET '+setString+' WHERE hid='+str(e['hid'])+';'
-            Logger.info('History sync query:'+query)
-            r=q(query) # return value is number of rows affected
-            Logger.info('  response='+str(r))
-            if r==0:
-                r=tdbAddHistoryEntry(
-                        entry=e['Entry'],
-                        hid=e['hid'],
-                        aid=e['aid'],
-                        tid=e['tid'],
-                        recordedBy=e['RecordedBy'],
-                        epoch=e['Epoch'])
-                Logger.info('   adding a history entry.  response:'+str(r))
         if self.sm.current=='teamsScreen' and len(result['Teams'])>0:
             self.showTeams()
         elif self.sm.current=='assignmentsScreen' and len(result['Assignments'])>0:
@@ -809,10 +1118,34 @@ class assignmentTrackerApp(App):
         elif self.sm.current=='pairingDetailScreen' and len(result['History'])>0:
             self.pairingDetailHistoryUpdate()
 
+    # resetIncident - start over with an empty local database, as at startup, so
+    #  that no rows of the previous incident are left behind
+    def resetIncident(self):
+        tdbInit()
+        self.lastSyncSeq=0
+        self.lastSyncTimeStamp=0
+        self.etags={}
+        self.teamNamePool=list(map(str,range(101,200)))
+        self.assignmentNamePool=[chr(a)+chr(b) for a in range(65,91) for b in range(65,91)]
+        self.redraw()
+
     def on_sync_failure(self,request,result):
         Logger.info("sync failure:"+str(result))
-        self.syncTimer.cancel()
-        self.textpopup("SYNC FAILURE","Sync failure.  The server is not responding to sync requests.  This node is no longer part of the AssignmentTracker incident.\n\nAborting. You can try to restart and join after the issue is remedied.",on_release=sys.exit)
+        self.syncInFlight=False
+        if self.syncChangeFeed and getattr(request,'resp_status',None)==404 and self.isSyncHostAnswer(request):
+            # a host from before the change feed; sync the old way from now on
+            Logger.info("host does not serve api/v1/changes; syncing with api/v1/since instead")
+            self.syncChangeFeed=False
+            Clock.schedule_once(partial(self.sync,since=self.lastSyncTimeStamp))
+            return
+        # keep trying: a brief network drop should not end this node's session;
+        #  the faded connection icon shows that this node may be out of date
+        self.syncFailures+=1
+        if self.syncFailures==1:
+            toast("Sync failed; retrying")
+        self.showConnDegraded(True)
+        delay=min(SYNC_RETRY_MIN*2**min(self.syncFailures-1,10),SYNC_RETRY_MAX)
+        self.scheduleSync(delay*random.uniform(0.5,1.5))
 
     def newTeam(self,name=None,resource=None,doToast=True):
         name=name or self.newTeamScreen.ids.nameSpinner.text
@@ -820,6 +1153,9 @@ class assignmentTrackerApp(App):
             self.teamNamePool.remove(name)
         resource=resource or self.newTeamScreen.ids.resourceSpinner.text
         r=tdbNewTeam(name,resource)
+        if 'error' in r: # e.g. the name is already taken
+            self.textpopup(title='New Team',text=r['error'])
+            return
         n=r['validate']['n']
         # send n (local db index) with the request payload, so that the response handler will have access to it;
         #   that way this specific n will be kept with this specific request, which prevents
@@ -839,6 +1175,9 @@ class assignmentTrackerApp(App):
         rb=request.req_body
         rbj=json.loads(rb)
         n=rbj.get('n',None) # local db index
+        if 'error' in response: # e.g. the host already has one with this name
+            Logger.warning('host did not add new team: '+str(response['error']))
+            return
         v=response['validate']
         tdbNewTeamFinalize(n,v['tid'],v['LastEditEpoch'])
 
@@ -848,6 +1187,9 @@ class assignmentTrackerApp(App):
             self.assignmentNamePool.remove(name)
         intendedResource=intendedResource or self.newAssignmentScreen.ids.resourceSpinner.text
         r=tdbNewAssignment(name,intendedResource,sid)
+        if 'error' in r: # e.g. the name is already taken
+            self.textpopup(title='New Assignment',text=r['error'])
+            return
         n=r['validate']['n']
         # send n (local db index) with the request payload, so that the response handler will have access to it;
         #   that way this specific n will be kept with this specific request, which prevents
@@ -867,6 +1209,9 @@ class assignmentTrackerApp(App):
         rb=request.req_body
         rbj=json.loads(rb)
         n=rbj.get('n',None) # local db index
+        if 'error' in response: # e.g. the host already has one with this name
+            Logger.warning('host did not add new assignment: '+str(response['error']))
+            return
         v=response['validate']
         tdbNewAssignmentFinalize(n,v['aid'],v['LastEditEpoch'])
 
@@ -898,15 +1243,21 @@ class assignmentTrackerApp(App):
         prevID=tdbGetPairingIDByNames(assignmentName,teamName,previousOnly=True)
         Logger.info("Checking for previous pairings with same assignment and same team: "+str(prevID))
         if prevID: # this is a repeat; reuse the existing ID rather than making a new pairing
-            tdbSetPairingStatusByID(prevID,'CURRENT')
-            self.sendRequest('api/v1/pairings/'+str(prevID)+'/status','PUT',{'NewStatus':'CURRENT'})
-            tdbSetTeamStatusByName(teamName,'ASSIGNED')
-            tdbSetAssignmentStatusByName(assignmentName,'ASSIGNED')                
+            try:
+                with tdbBatch(): # one transaction and one push for all three changes
+                    tdbSetPairingStatusByID(prevID,'CURRENT')
+                    tdbSetTeamStatusByName(teamName,'ASSIGNED')
+                    tdbSetAssignmentStatusByName(assignmentName,'ASSIGNED')
+            except sqlite3.Error as e:
+                self.localBatchFailed(e)
+                return -1
             # api call for a new pairing takes care of setting the team and assignment status
             #  on the host, but we purposely are not making that call here, so we need to do
-            #  those api calls separately
-            self.sendRequest('api/v1/teams/'+str(tid)+'/status','PUT',{'NewStatus':'ASSIGNED'})
-            self.sendRequest('api/v1/assignments/'+str(aid)+'/status','PUT',{'NewStatus':'ASSIGNED','PushTables':'True'})
+            #  those api calls separately; send them as one batch (one round trip, one push)
+            with self.requestBatch():
+                self.sendRequest('api/v1/pairings/'+str(prevID)+'/status','PUT',{'NewStatus':'CURRENT'})
+                self.sendRequest('api/v1/teams/'+str(tid)+'/status','PUT',{'NewStatus':'ASSIGNED'})
+                self.sendRequest('api/v1/assignments/'+str(aid)+'/status','PUT',{'NewStatus':'ASSIGNED','PushTables':'True'})
         else:
             r=tdbNewPairing(aid,tid) # also sets team and assignment to ASSIGNED
             n=r['validate']['n']
@@ -956,18 +1307,7 @@ class assignmentTrackerApp(App):
         Logger.info('showTeams called')
         Logger.info("screenStack: "+str(self.screenStack))
         self.buildLists()
-        # recycleview needs a list of dictionaries; the view divides into rows every nth element
-        self.teamsScreen.teamsRVData=[]
-        for entry in self.teamsList:
-            row=copy.deepcopy(entry)
-            for cell in row:
-                d={}
-                d['text']=str(cell)
-                d['bg']=(0,0,0,0)
-                d['src']=''
-                if cell in self.medicalTeams:
-                    d['src']=self.medicalIconSrc
-                self.teamsScreen.teamsRVData.append(d)
+        self.updateRVData(self.teamsScreen.ids.teamsRV,self.teamsList,list(keyTeamsViewRows(self.teamsList)))
         # if previous screen was assignments, just replace it in the stack; otherwise, append
         if self.screenStack[-1]=='assignmentsScreen':
             self.sm.transition=NoTransition()
@@ -981,18 +1321,7 @@ class assignmentTrackerApp(App):
         Logger.info("showAssignments called")
         Logger.info("screenStack: "+str(self.screenStack))
         self.buildLists()
-        # recycleview needs a list of dictionaries; the view divides into rows every nth element
-        self.assignmentsScreen.assignmentsRVData=[]
-        for entry in self.assignmentsList:
-            row=copy.deepcopy(entry)
-            for cell in row:
-                d={}
-                d['text']=str(cell)
-                d['bg']=(0,0,0,0)
-                d['src']=''
-                if cell in self.medicalTeams:
-                    d['src']=self.medicalIconSrc
-                self.assignmentsScreen.assignmentsRVData.append(d)
+        self.updateRVData(self.assignmentsScreen.ids.assignmentsRV,self.assignmentsList,list(keyAssignmentsViewRows(self.assignmentsList)))
         # if previous screen was teams, just replace it in the stack; otherwise, append
         if self.screenStack[-1]=='teamsScreen':
             self.sm.transition=NoTransition()
@@ -1002,9 +1331,49 @@ class assignmentTrackerApp(App):
         self.sm.current='assignmentsScreen'
         self.sm.transition=SlideTransition(direction='left')
 
+    def rvCells(self,row):
+        cells=[]
+        for cell in row:
+            d={}
+            d['text']=str(cell)
+            d['bg']=(0,0,0,0)
+            d['src']=''
+            if cell in self.medicalTeams:
+                d['src']=self.medicalIconSrc
+            cells.append(d)
+        return cells
+
+    # updateRVData - bring a teams or assignments RecycleView up to date with rows
+    #  in place: the recycleview needs a list of dictionaries, and the view divides
+    #  into rows every nth element.  Rows are matched by key, so only cells whose
+    #  text or icon changed are replaced, and added or removed rows are inserted
+    #  or deleted at their position; the RecycleView then only refreshes those
+    #  cells and keeps its scroll position, instead of laying out the whole grid.
+    def updateRVData(self,rv,rows,keys):
+        cols=rv.layout_manager.cols
+        oldKeys=self.rvKeys.get(rv,[])
+        self.rvKeys[rv]=keys
+        if len(rv.data)!=len(oldKeys)*cols: # first time, or the data was replaced elsewhere
+            rv.data=[d for row in rows for d in self.rvCells(row)]
+            return
+        # apply the edits from the end, so the row positions of the edits that
+        #  are still to be applied don't change
+        for (op,i1,i2,j1,j2) in reversed(difflib.SequenceMatcher(None,oldKeys,keys,autojunk=False).get_opcodes()):
+            if op=='equal':
+                for (i,j) in zip(range(i1,i2),range(j1,j2)):
+                    for (c,d) in enumerate(self.rvCells(rows[j])):
+                        old=rv.data[i*cols+c]
+                        if old['text']!=d['text'] or old['src']!=d['src']:
+                            rv.data[i*cols+c]=d
+            else: # replace, delete, or insert
+                rv.data[i1*cols:i2*cols]=[d for row in rows[j1:j2] for d in self.rvCells(row)]
+
     def updateCounts(self):
         Logger.info('updateCounts called')
-        d=tdbPushTables() # clients won't actually push websockets, but the return value has the counts
+        d=tdbGetCounts() # cached by the board model until something changes
+        if d==self.counts: # the buttons already show these counts
+            return
+        self.counts=d
         # self.unassignedTeamsCount=len([x for x in self.teamsList if x[1]=='UNASSIGNED'])
         # self.assignedTeamsCount=len(self.teamsList)-self.unassignedTeamsCount
         # self.unassignedAssignmentsCount=len([x for x in self.assignmentsList if x[2]=='UNASSIGNED'])
@@ -1127,17 +1496,81 @@ class assignmentTrackerApp(App):
         newIndex=currentIndex+1
         self.pairingDetailScreen.ids.statusSpinner.text=statusList[newIndex] # go to the next logical status by default
 
+    # the activity log shows the newest entries first, one page at a time:
+    #  the first page is loaded when the pairing detail screen is shown, older
+    #  pages are loaded as the user scrolls to the bottom, and entries recorded
+    #  after that are inserted at the top, without rebuilding the whole list
     def pairingDetailHistoryUpdate(self):
         [assignmentName,teamName]=self.pairingDetailBeingShown
+        rv=self.pairingDetailScreen.ids.historyRV
+        if self.historySearchActive:
+            if self.historyShown==self.pairingDetailBeingShown:
+                return # keep showing the search results until the search is cleared
+            # a different pairing: clear the search
+            self.historySearchActive=False
+            self.pairingDetailScreen.ids.historySearchInput.text=''
+            self.pairingDetailScreen.ids.historyLabel.text='Activity Log'
+        if self.historyShown!=self.pairingDetailBeingShown:
+            # a different pairing: start over with the first page
+            self.historyShown=list(self.pairingDetailBeingShown)
+            self.historyNewestN=None
+            self.historyOldestN=None
+            self.historyAllLoaded=False
+            rv.data=[]
+            rv.scroll_y=1
+            self.pairingDetailHistoryLoadOlder()
+            return
+        if self.historyNewestN is None: # nothing shown yet
+            self.pairingDetailHistoryLoadOlder()
+            return
+        history=self.pairingDetailHistoryGet(afterN=self.historyNewestN)
+        if history:
+            self.historyNewestN=history[0]['n']
+            rv.data[0:0]=self.historyCells(history)
+
+    def pairingDetailHistoryLoadOlder(self,*args):
+        if self.historyAllLoaded or not self.historyShown or self.historySearchActive:
+            return
+        history=self.pairingDetailHistoryGet(limit=HISTORY_PAGE_SIZE,beforeN=self.historyOldestN)
+        if len(history)<HISTORY_PAGE_SIZE:
+            self.historyAllLoaded=True
+        if history:
+            if self.historyNewestN is None:
+                self.historyNewestN=history[0]['n']
+            self.historyOldestN=history[-1]['n']
+            self.pairingDetailScreen.ids.historyRV.data.extend(self.historyCells(history))
+
+    # search box: show the best matching entries from the whole incident history
+    #  in place of the activity log; clearing the search shows the log again
+    def pairingDetailHistorySearch(self,text):
+        rv=self.pairingDetailScreen.ids.historyRV
+        if not text.strip():
+            self.historySearchActive=False
+            self.pairingDetailScreen.ids.historyLabel.text='Activity Log'
+            self.historyShown=None # reload the activity log from the first page
+            self.pairingDetailHistoryUpdate()
+            return
+        self.historySearchActive=True
+        results=tdbSearchHistory(text,limit=HISTORY_PAGE_SIZE)
+        self.pairingDetailScreen.ids.historyLabel.text='Search: '+str(len(results))+' entries'
+        rv.data=self.historyCells(results)
+        rv.scroll_y=1
+
+    # called when the activity log is scrolled; load the next page near the bottom
+    def on_historyScroll(self,rv):
+        if rv.scroll_y<=0.05:
+            self.pairingDetailHistoryLoadOlder()
+
+    def pairingDetailHistoryGet(self,limit=None,beforeN=None,afterN=None):
+        [assignmentName,teamName]=self.historyShown
         # get history from tdb, regardless of connections
-        if teamName:
-            history=[[x['Entry'],x['RecordedBy'],time.strftime('%H:%M',time.localtime(x['Epoch']))] for x in
-                    tdbGetHistory(aid=tdbGetAssignmentIDByName(assignmentName),tid=tdbGetTeamIDByName(teamName))[::-1]]
-        else:
-            history=[[x['Entry'],x['RecordedBy'],time.strftime('%H:%M',time.localtime(x['Epoch']))] for x in
-                    tdbGetHistory(aid=tdbGetAssignmentIDByName(assignmentName))[::-1]]
-        history=[y for x in history for y in x] # flattened list, needed by RecycleGridLayout
-        self.pairingDetailScreen.ids.historyRV.data=[{'text': str(x)} for x in history]
+        aid=tdbGetAssignmentIDByName(assignmentName)
+        tid=tdbGetTeamIDByName(teamName) if teamName else None
+        return tdbGetHistory(aid=aid,tid=tid,limit=limit,beforeN=beforeN,afterN=afterN) or []
+
+    def historyCells(self,history):
+        rows=[[x['Entry'],x['RecordedBy'],time.strftime('%H:%M',time.localtime(x['Epoch']))] for x in history]
+        return [{'text': str(y)} for x in rows for y in x] # flattened list, needed by RecycleGridLayout
       
     def showNewTeam(self,*args):
         Logger.info('showNewTeam called')
@@ -1192,7 +1625,7 @@ class assignmentTrackerApp(App):
                 # Logger.info('  pairings:'+str(pairings))
                 aids=[pairing.get('aid',None) for pairing in pairings]
                 # Logger.info('  aids:'+str(aids))
-                assignmentNames=[tdbGetAssignments(aid)[0]['AssignmentName'] for aid in aids]
+                assignmentNames=tdbGetAssignmentNamesByIDs(aids)
                 # Logger.info('  assignmentNames:'+str(assignmentNames))
                 status+=','.join(assignmentNames)
             self.newPairingScreen.ids.currentlyLabel.text=status
@@ -1218,7 +1651,7 @@ class assignmentTrackerApp(App):
                         # also, assignments already paired to multiple teams should only be one entry
                         pairings=tdbGetPairingsByAssignment(tdbGetAssignmentIDByName(aName),currentOnly=True)
                         tids=[pairing.get('tid',None) for pairing in pairings]
-                        tNames=[tdbGetTeams(tid)[0]['TeamName'] for tid in tids]
+                        tNames=tdbGetTeamNamesByIDs(tids)
                         tNameText=','.join(tNames)
                         entryText+=' : ASSIGNED to '+tNameText
                         assignmentNames.append(aName) # don't process it again
@@ -1253,7 +1686,7 @@ class assignmentTrackerApp(App):
                 # Logger.info('  pairings:'+str(pairings))
                 tids=[pairing.get('tid',None) for pairing in pairings]
                 # Logger.info('  tids:'+str(tids))
-                teamNames=[tdbGetTeams(tid)[0]['TeamName'] for tid in tids]
+                teamNames=tdbGetTeamNamesByIDs(tids)
                 # Logger.info('  teamNames:'+str(teamNames))
                 status+=','.join(teamNames)
             self.newPairingScreen.ids.currentlyLabel.text=status
@@ -1387,10 +1820,15 @@ class assignmentTrackerApp(App):
         def teamEditAccept(*args):
             newR=resourceSpinner.text
             newM=medicalSpinner.text
-            tdbSetTeamResourceByID(tid,newR)
-            self.sendRequest("api/v1/teams/"+str(tid)+"/resource","PUT",{"Resource":str(newR)})
-            tdbSetTeamMedicalByID(tid,newM)
-            self.sendRequest("api/v1/teams/"+str(tid)+"/medical","PUT",{"Medical":str(newM)})
+            try:
+                with self.requestBatch(),tdbBatch():
+                    tdbSetTeamResourceByID(tid,newR)
+                    self.sendRequest("api/v1/teams/"+str(tid)+"/resource","PUT",{"Resource":str(newR)})
+                    tdbSetTeamMedicalByID(tid,newM)
+                    self.sendRequest("api/v1/teams/"+str(tid)+"/medical","PUT",{"Medical":str(newM)})
+            except sqlite3.Error as e:
+                self.localBatchFailed(e)
+                return
             self.pairingDetailScreen.ids.teamResourceLabel.text=str(newR)
             self.pairingDetailHistoryUpdate()
         okButton.bind(on_release=teamEditAccept)
@@ -1441,22 +1879,33 @@ class assignmentTrackerApp(App):
             # note, when an pairing changes to COMPLETED, its team name and (team) resource
             #  fields should be saved as strings, in case the team is later deleted
             [assignmentName,teamName]=self.pairingDetailBeingShown
-            # 1. set pairing status to PREVIOUS
-            pid=tdbGetPairingIDByNames(assignmentName,teamName)
-            tdbSetPairingStatusByID(pid,'PREVIOUS')
-            self.sendRequest("api/v1/pairings/"+str(pid)+"/status","PUT",{"NewStatus":"PREVIOUS"})
-            # 2. set team status to UNASSIGNED if it is not in any current pairings
-            tid=tdbGetTeamIDByName(teamName)
-            others=tdbGetPairingsByTeam(tid,currentOnly=True)
-            if not others:
-                tdbSetTeamStatusByID(tid,'UNASSIGNED')
-                self.sendRequest("api/v1/teams/"+str(tid)+"/status","PUT",{"NewStatus":"UNASSIGNED"})
-            # 3. set assignment status to COMPLETED if it is not in any current pairings
-            aid=tdbGetAssignmentIDByName(assignmentName)
-            others=tdbGetPairingsByAssignment(aid,currentOnly=True)
-            if not others:
-                tdbSetAssignmentStatusByID(aid,'COMPLETED')
-                self.sendRequest("api/v1/assignments/"+str(aid)+"/status","PUT",{"NewStatus":"COMPLETED"})
+            # make all the local changes in one batch (one transaction, one push),
+            #  then send the corresponding requests to the host
+            requests=[]
+            try:
+                with tdbBatch():
+                    # 1. set pairing status to PREVIOUS
+                    pid=tdbGetPairingIDByNames(assignmentName,teamName)
+                    tdbSetPairingStatusByID(pid,'PREVIOUS')
+                    requests.append(["api/v1/pairings/"+str(pid)+"/status",{"NewStatus":"PREVIOUS"}])
+                    # 2. set team status to UNASSIGNED if it is not in any current pairings
+                    tid=tdbGetTeamIDByName(teamName)
+                    others=tdbGetPairingsByTeam(tid,currentOnly=True)
+                    if not others:
+                        tdbSetTeamStatusByID(tid,'UNASSIGNED')
+                        requests.append(["api/v1/teams/"+str(tid)+"/status",{"NewStatus":"UNASSIGNED"}])
+                    # 3. set assignment status to COMPLETED if it is not in any current pairings
+                    aid=tdbGetAssignmentIDByName(assignmentName)
+                    others=tdbGetPairingsByAssignment(aid,currentOnly=True)
+                    if not others:
+                        tdbSetAssignmentStatusByID(aid,'COMPLETED')
+                        requests.append(["api/v1/assignments/"+str(aid)+"/status",{"NewStatus":"COMPLETED"}])
+            except sqlite3.Error as e:
+                self.localBatchFailed(e)
+                return
+            with self.requestBatch():
+                for [api,payload] in requests:
+                    self.sendRequest(api,"PUT",payload)
             self.textpopup(
                     title='Pairing completed',
                     text='A pairing has been completed:\n  Assignment='+assignmentName+'  Team='+teamName+'\n\n'+COMPLETED_PAIRING_POPUP_TEXT)
@@ -1470,6 +1919,13 @@ class assignmentTrackerApp(App):
             self.pairingDetailStatusUpdate()
             self.pairingDetailHistoryUpdate()
 
+    # localBatchFailed - a local tdbBatch was rolled back; nothing was changed or sent
+    def localBatchFailed(self,e):
+        Logger.error("local database change failed and was rolled back: "+str(e))
+        self.textpopup(
+                title='Database Error',
+                text='The change could not be saved on this device, and was not sent:\n'+str(e))
+
     def textpopup(self, title='', text='', buttonText='OK', on_release=None, size_hint=(0.8,None)):
         popup=ExpandingPopup(title=title)
         popup.text=text
@@ -1552,11 +2008,11 @@ class SelectableLabel(RecycleDataViewBehavior, Label):
 
 
 class TeamsScreen(Screen):
-    teamsRVData=ListProperty([])
+    pass
 
 
 class AssignmentsScreen(Screen):
-    assignmentsRVData=ListProperty([])
+    pass
 
 
 class PairingDetailScreen(Screen):
@@ -1588,6 +2044,199 @@ class ExpandingPopup(Popup):
     pass
 
 
+# ChangeListener - listen for the host's change notifications (see 'CHANGE FEED'
+#  in assignmentTracker_db.py) on the same websocket repeater, or pusher.com
+#  channel, that the browser viewers use.  The websocket is read on a background
+#  thread, which reconnects with backoff if the connection is lost; each
+#  notification is handed to on_changes on the kivy thread, via Clock.
+class ChangeListener():
+    def __init__(self,url,on_changes,pusherChannel=None):
+        self.url=url
+        self.on_changes=on_changes
+        self.pusherChannel=pusherChannel # url is a pusher.com url; subscribe to this channel
+        self.ws=None
+        self.connected=threading.Event()
+        self.stopped=False
+        self.thread=threading.Thread(target=self.run,name='changeListener',daemon=True)
+        self.thread.start()
+
+    def run(self):
+        backoff=WS_BACKOFF_MIN
+        while not self.stopped:
+            try:
+                self.ws=create_connection(self.url,timeout=CHANGE_LISTENER_PING)
+                Logger.info("change listener connected to "+self.url)
+                backoff=WS_BACKOFF_MIN
+                self.listen()
+            except Exception as e:
+                if self.stopped:
+                    break
+                Logger.info("change listener connection to "+self.url+" lost or failed; retrying in "+str(backoff)+" seconds: "+str(e))
+            self.connected.clear()
+            if self.ws:
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
+            self.ws=None
+            time.sleep(backoff)
+            backoff=min(backoff*2,WS_BACKOFF_MAX)
+
+    def listen(self):
+        if not self.pusherChannel:
+            self.connected.set()
+        while not self.stopped:
+            try:
+                message=self.ws.recv()
+            except WebSocketTimeoutException: # quiet for a while; make sure the connection is still there
+                if self.pusherChannel:
+                    self.ws.send(json.dumps({'event':'pusher:ping','data':{}}))
+                else:
+                    self.ws.ping()
+                continue
+            if not message: # closed by the other end
+                raise ConnectionError('connection closed')
+            try:
+                d=json.loads(message)
+                if self.pusherChannel:
+                    event=d.get('event')
+                    if event=='pusher:connection_established':
+                        self.ws.send(json.dumps({'event':'pusher:subscribe','data':{'channel':self.pusherChannel}}))
+                    elif event=='pusher:subscription_succeeded':
+                        self.connected.set()
+                    elif event=='pusher:ping':
+                        self.ws.send(json.dumps({'event':'pusher:pong','data':{}}))
+                    if d.get('channel')!=self.pusherChannel or str(event).startswith('pusher'):
+                        continue
+                    d=json.loads(d['data'])
+                msg=json.loads(d['msg'])
+            except Exception: # not a tracker message
+                continue
+            if isinstance(msg,dict) and msg.get('type')=='changes':
+                Clock.schedule_once(partial(self.on_changes,msg))
+
+    def isConnected(self):
+        return self.connected.is_set()
+
+    def stop(self):
+        self.stopped=True
+        if self.ws:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+
+
+# FanOut - one request sent to each of several hosts at the same time.  The
+#  completion policy decides when the request as a whole has succeeded: when
+#  the first host succeeds (FANOUT_FIRST), when all of them have (FANOUT_ALL),
+#  or when more than half have (FANOUT_QUORUM); it has failed as soon as that
+#  can no longer happen.  Then the caller's callback is called, once: on_success
+#  gets the response of the most preferred host that succeeded, with a 'hosts'
+#  entry added (if the response is a dict) giving each host's status and time.
+#  Answers that arrive later only go into the host stats, so a slow host never
+#  holds up the others; on_host_failure, if given, sees every host's failure,
+#  even a late one.  A blocking request (timeout=...) waits for the hosts
+#  together rather than one after another.
+class FanOut():
+    def __init__(self,app,hosts,policy,kwargs):
+        self.app=app
+        self.hosts=hosts
+        self.policy=policy
+        self.kwargs=dict(kwargs)
+        self.timeout=self.kwargs.get('timeout')
+        self.callbacks={}
+        for kind in ['on_success','on_failure','on_error']:
+            self.callbacks[kind]=self.kwargs.pop(kind,None) or app.request_callback
+        self.callbacks['on_not_modified']=self.kwargs.pop('on_not_modified',None)
+        # on_host_failure(server,request,result): called for each host's failure
+        #  before the policy sees it; returns True if it took care of that host
+        self.onHostFailure=self.kwargs.pop('on_host_failure',None)
+        self.answers={} # host name : [kind,request,result,ms]
+        self.sent=None
+        self.decided=False
+        self.result=None
+
+    def needed(self):
+        if self.policy==FANOUT_ALL:
+            return len(self.hosts)
+        if self.policy==FANOUT_QUORUM:
+            return len(self.hosts)//2+1
+        return 1
+
+    def send(self,urlEnd,method,body):
+        self.sent=time.time()
+        if not self.timeout:
+            for [name,server] in self.hosts:
+                kwargs=dict(self.kwargs,on_success=self.callback(name,'on_success'),
+                        on_failure=self.callback(name,'on_failure'),on_error=self.callback(name,'on_error'))
+                if self.callbacks['on_not_modified']:
+                    kwargs['on_not_modified']=self.callback(name,'on_not_modified')
+                self.app.request(server,urlEnd,method,body,**kwargs)
+            return 'Asynchronous request has been sent.'
+        requests={name:self.app.request(server,urlEnd,method,body,block=False,**self.kwargs) for [name,server] in self.hosts}
+        while requests and not self.decided and time.time()-self.sent<self.timeout:
+            for (name,req) in list(requests.items()):
+                req._dispatch_result(0)
+                if req.is_finished:
+                    del requests[name]
+                    if req.error is None and req.resp_status is not None and req.resp_status<400:
+                        self.answer(name,'on_success',req,req.result)
+                    else:
+                        self.answer(name,'on_error' if req.error is not None else 'on_failure',req,req.error or req.result)
+            if requests and not self.decided:
+                time.sleep(FANOUT_POLL)
+        if not self.decided:
+            for name in requests: # still unanswered at the timeout
+                self.app.recordHostResult(name,False,round((time.time()-self.sent)*1000),'timed out')
+        return self.result
+
+    def callback(self,name,kind):
+        def f(request,result):
+            self.answer(name,kind,request,result)
+        return f
+
+    def answer(self,name,kind,request,result):
+        ms=round((time.time()-self.sent)*1000)
+        server=dict(self.hosts).get(name)
+        if kind=='on_failure' and server and self.onHostFailure and self.onHostFailure(server,request,result):
+            # the failure was taken care of for this host (e.g. by sending the
+            #  request another way); the policy applies to the other hosts
+            self.app.recordHostResult(name,True,ms)
+            self.hosts=[h for h in self.hosts if h[0]!=name]
+            if not self.hosts:
+                self.decided=True
+        else:
+            ok=kind in ['on_success','on_not_modified']
+            self.app.recordHostResult(name,ok,ms,None if ok else (getattr(request,'resp_status',None) or result))
+            self.answers[name]=[kind,request,result,ms]
+        if not self.decided:
+            self.decide()
+
+    def decide(self):
+        okNames=[n for [n,s] in self.hosts if n in self.answers and self.answers[n][0] in ['on_success','on_not_modified']]
+        failed=[a for (n,a) in self.answers.items() if n not in okNames]
+        if len(okNames)>=self.needed():
+            self.decided=True
+            # the most preferred host that succeeded
+            [kind,request,result,ms]=self.answers[okNames[0]]
+            if len(self.answers)>1 and type(result) is dict:
+                result=dict(result,hosts={n:{'ok':n in okNames,'status':getattr(a[1],'resp_status',None),'ms':a[3]} for (n,a) in self.answers.items()})
+            self.finish(kind,request,result)
+        elif len(failed)>len(self.hosts)-self.needed():
+            self.decided=True
+            [kind,request,result,ms]=failed[-1] # the failure that decided it
+            self.finish(kind,request,result)
+
+    def finish(self,kind,request,result):
+        if kind=='on_success':
+            self.result=result
+        if self.timeout: # blocking: the caller gets the result, there are no callbacks
+            return
+        if self.callbacks[kind]:
+            self.callbacks[kind](request,result)
+
+
 if __name__ == '__main__':
     theApp=assignmentTrackerApp()
     theApp.run()
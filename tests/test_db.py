@@ -0,0 +1,40 @@
+# tests for assignmentTracker_db, each on a new incident database in a temporary directory
+
+import pytest
+
+import assignmentTracker_db as db
+
+
+@pytest.fixture
+def incident(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db.tdbInit()
+    yield
+    db.tdbCloseConnections()
+
+
+@pytest.mark.parametrize('isHost',[False,True])
+def test_duplicate_team_name(incident,monkeypatch,isHost):
+    monkeypatch.setattr(db,'host',isHost)
+    assert 'validate' in db.tdbNewTeam('101','GROUND')
+    r=db.tdbNewTeam('101','AIR')
+    assert 'error' in r
+    assert db.q("SELECT Resource FROM Teams WHERE TeamName='101';")==[{'Resource':'GROUND'}]
+    assert db.tdbCheckBoard()==[]
+
+
+def test_duplicate_assignment_name(incident):
+    assert 'validate' in db.tdbNewAssignment('AA','GROUND')
+    assert 'error' in db.tdbNewAssignment('AA','AIR')
+    assert len(db.q("SELECT * FROM Assignments;"))==1
+    assert db.tdbCheckBoard()==[]
+
+
+def test_duplicate_name_in_batch(incident,monkeypatch):
+    monkeypatch.setattr(db,'host',True)
+    db.tdbNewTeam('101','GROUND')
+    r=db.tdbApplyBatch([
+            {'method':'POST','url':'teams/new','body':{'TeamName':'102','Resource':'GROUND'}},
+            {'method':'POST','url':'teams/new','body':{'TeamName':'101','Resource':'AIR'}}])
+    assert all('error' in x for x in r['results'])
+    assert [x['TeamName'] for x in db.q("SELECT TeamName FROM Teams;")]==['101']
@@ -0,0 +1,69 @@
+# tests for sending requests through assignmentTrackerApp.sendRequest / FanOut
+#  without a host: UrlRequest is replaced by a fake that answers right away
+
+import types
+
+import pytest
+
+pytest.importorskip('sartopo_python')
+pytest.importorskip('websocket')
+import main
+
+
+class FakeUrlRequest():
+    status=200
+    result=None
+    sent=[]
+
+    def __init__(self,url,on_success=None,on_redirect=None,on_failure=None,on_error=None,req_headers=None,**kwargs):
+        FakeUrlRequest.sent.append([url,req_headers])
+        request=types.SimpleNamespace(url=url,resp_status=self.status,resp_headers={},req_headers=req_headers,req_body=kwargs.get('req_body'))
+        if self.status==304:
+            on_redirect(request,self.result)
+        elif self.status<400:
+            on_success(request,self.result)
+        else:
+            on_failure(request,self.result)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(main,'UrlRequest',FakeUrlRequest)
+    FakeUrlRequest.sent=[]
+    a=main.assignmentTrackerApp()
+    a.tracker_api_key='test'
+    a.etags={}
+    a.inFlight={}
+    a.keepAlive=True
+    a.notModifiedCount=0
+    a.coalescedCount=0
+    a.syncSkippedCount=0
+    a.batchOps=None
+    a.fanoutPolicy=main.FANOUT_FIRST
+    a.hostStats={}
+    a.lan=True
+    a.cloud=False
+    a.localhost=False
+    a.lanServer='http://lan'
+    return a
+
+
+def test_not_modified(app,monkeypatch):
+    monkeypatch.setattr(FakeUrlRequest,'status',304)
+    app.etags['http://lan/api/v1/changes/5']='"5"'
+    answers=[]
+    app.sendRequest('api/v1/changes/5',useETag=True,
+            on_success=lambda request,result: answers.append('success'),
+            on_not_modified=lambda request,result: answers.append('not modified'))
+    assert answers==['not modified']
+    assert FakeUrlRequest.sent[0][1]['If-None-Match']=='"5"'
+    assert app.notModifiedCount==1
+    assert app.getHostStats()['lan']['failures']==0
+
+
+def test_sync_not_modified(app,monkeypatch):
+    monkeypatch.setattr(FakeUrlRequest,'status',304)
+    done=[]
+    monkeypatch.setattr(app,'syncDone',lambda active: done.append(active),raising=False)
+    app.sendRequest('api/v1/changes/5',useETag=True,on_not_modified=app.on_sync_not_modified)
+    assert done==[False]
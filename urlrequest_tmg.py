@@ -54,21 +54,42 @@ Example of Posting data (adapted from httplib example)::
 
 If you want a synchronous request, you can call the wait() method.
 
+Requests run on a small fixed set of worker threads (see
+:data:`URLREQUEST_WORKERS`), not on a thread of their own. Waiting requests
+are started in order of their `priority` lane: user actions
+(:data:`LANE_USER`), then sync (:data:`LANE_SYNC`), then everything else
+(:data:`LANE_BACKGROUND`); see :func:`get_lane_stats`. No one host may occupy
+more than :data:`URLREQUEST_MAX_PER_HOST` of the workers, so a slow host
+doesn't delay requests to a fast one.
+
+With ``keep_alive=True``, requests to the same host share persistent
+connections from :data:`connection_pool` instead of opening (and, for https,
+negotiating TLS on) a new connection for every request; see
+:func:`get_pool_stats`.
+
 '''
 
 from base64 import b64encode
 from collections import deque
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Semaphore
 from json import loads
-from time import sleep
+from time import sleep, time
 from kivy.compat import PY2
+try:
+    from queue import PriorityQueue, Full
+except ImportError:
+    from Queue import PriorityQueue, Full
+from itertools import count
+from heapq import heappush, heappop
 from kivy.config import Config
 
 if PY2:
-    from httplib import HTTPConnection
+    from httplib import HTTPConnection, HTTPException, BadStatusLine
     from urlparse import urlparse, urlunparse
+    from socket import error as ConnectionResetError
+    BrokenPipeError = RemoteDisconnected = BadStatusLine
 else:
-    from http.client import HTTPConnection
+    from http.client import HTTPConnection, HTTPException, RemoteDisconnected
     from urllib.parse import urlparse, urlunparse
 
 try:
@@ -92,8 +113,241 @@ from kivy.logger import Logger
 # list to save UrlRequest and prevent GC on un-referenced objects
 g_requests = []
 
+#: number of worker threads that run requests
+URLREQUEST_WORKERS = 4
+
+#: maximum number of requests waiting for a worker; a request made while the
+#: queue is full fails right away, with an error passed to on_error
+URLREQUEST_QUEUE_SIZE = 64
+
+#: most workers that requests to one host may occupy at a time, so that a slow
+#: host (for example the cloud server) can't hold up requests to the others;
+#: further requests to that host wait their turn, and are not counted against
+#: :data:`URLREQUEST_QUEUE_SIZE`
+URLREQUEST_MAX_PER_HOST = 2
+
+#: socket timeout (seconds) for requests made without a `timeout`, so that a
+#: host that accepts the connection and never answers can't hold its workers
+#: (and the requests waiting for them) forever; the request then fails with
+#: the timeout error passed to on_error
+URLREQUEST_TIMEOUT = 20
+
+#: priority lanes: waiting requests in a lower numbered lane start first
+LANE_USER = 0
+LANE_SYNC = 1
+LANE_BACKGROUND = 2
+LANE_NAMES = {LANE_USER: 'user', LANE_SYNC: 'sync', LANE_BACKGROUND: 'background'}
+
+
+class RequestExecutor(object):
+    '''Runs each submitted request's run() method on one of a fixed number
+    of worker threads, which are started when the first request is submitted.
+    Waiting requests are taken in order of priority, then of submission;
+    a request whose host already has max_per_host requests running is set
+    aside, and run by the worker that finishes one of those.
+    '''
+
+    def __init__(self, workers=URLREQUEST_WORKERS,
+                 queue_size=URLREQUEST_QUEUE_SIZE,
+                 max_per_host=URLREQUEST_MAX_PER_HOST):
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self._queue = PriorityQueue(queue_size)
+        self._order = count()
+        self._threads = []
+        self._lock = Lock()
+        self._running = {}  # host : requests running
+        self._held = {}  # host : heap of (priority, order, request) set aside
+        # lane : requests started, and their total and longest queue wait
+        self.stats = {}
+
+    def submit(self, request):
+        '''Queue request; raises queue.Full if the queue is full.'''
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = Thread(target=self._work,
+                                    name='UrlRequest-{}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        request._submitted = time()
+        self._queue.put_nowait((request.priority, next(self._order), request))
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            host = urlparse(entry[2].url).netloc
+            with self._lock:
+                if self._running.get(host, 0) >= self.max_per_host:
+                    heappush(self._held.setdefault(host, []), entry)
+                    continue
+                self._running[host] = self._running.get(host, 0) + 1
+            while entry is not None:
+                self._run(*entry)
+                with self._lock:
+                    if self._held.get(host):
+                        entry = heappop(self._held[host])
+                    else:
+                        entry = None
+                        self._running[host] -= 1
+
+    def _run(self, priority, order, request):
+        wait = time() - request._submitted
+        with self._lock:
+            lane = self.stats.setdefault(
+                LANE_NAMES.get(priority, str(priority)),
+                {'requests': 0, 'waitTotal': 0.0, 'waitMax': 0.0})
+            lane['requests'] += 1
+            lane['waitTotal'] += wait
+            lane['waitMax'] = max(lane['waitMax'], wait)
+        try:
+            request.run()
+        except Exception as e:
+            Logger.exception('UrlRequest: worker error: {}'.format(e))
+
+
+#: the executor that runs all requests
+request_executor = RequestExecutor()
+
+
+def get_lane_stats():
+    '''Return, for each priority lane, the number of requests started and
+    their average and longest wait (seconds) in the queue.
+    '''
+    with request_executor._lock:
+        stats = dict((lane, dict(d)) for lane, d in
+                     request_executor.stats.items())
+    for d in stats.values():
+        d['waitAvg'] = d['waitTotal'] / d['requests']
+    return stats
+
+#: maximum number of connections (in use or idle) to one host for keep_alive
+#: requests; further requests to that host wait for a connection to be free
+POOL_MAX_PER_HOST = 4
+
+#: idle pooled connections older than this many seconds are closed instead of
+#: reused, since the server has probably closed them already
+POOL_IDLE_TIMEOUT = 60
+
+
+class ConnectionPool(object):
+    '''Persistent connections for keep_alive requests, kept per scheme, host,
+    port and ssl options. Each connection is used by one request at a time,
+    and is given back once its response has been read in full. New https
+    connections to a host resume the TLS session of an earlier connection,
+    which saves most of the handshake.
+    '''
+
+    def __init__(self, max_per_host=POOL_MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._lock = Lock()
+        self._hosts = {}
+        self.stats = {'new': 0, 'reused': 0, 'stale': 0, 'tls_resumed': 0}
+
+    def _host(self, key):
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = {
+                    'idle': [],  # [connection, time returned]
+                    'slots': Semaphore(self.max_per_host),
+                    'context': None,  # ssl context shared by the connections
+                    'session': None}  # TLS session to resume
+            return host
+
+    def get(self, key, factory, fresh=False):
+        '''Return (connection, reused). factory(host) makes a new connection
+        if there is no idle one, or if fresh is True.
+        '''
+        host = self._host(key)
+        host['slots'].acquire()
+        try:
+            with self._lock:
+                while host['idle'] and not fresh:
+                    conn, returned = host['idle'].pop()
+                    if time() - returned < POOL_IDLE_TIMEOUT:
+                        self.stats['reused'] += 1
+                        return conn, True
+                    conn.close()
+                self.stats['new'] += 1
+            return factory(host), False
+        except:
+            host['slots'].release()
+            raise
+
+    def replace(self, key, conn, factory):
+        '''Close a pooled connection that turned out to be stale, and return
+        a new one in its place.
+        '''
+        conn.close()
+        with self._lock:
+            self.stats['stale'] += 1
+            self.stats['new'] += 1
+        return factory(self._host(key))
+
+    def put(self, key, conn, reusable):
+        host = self._host(key)
+        with self._lock:
+            if reusable and conn.sock is not None:
+                if getattr(conn.sock, 'session', None) is not None:
+                    host['session'] = conn.sock.session
+                host['idle'].append([conn, time()])
+            else:
+                conn.close()
+        host['slots'].release()
+
+    def clear(self):
+        with self._lock:
+            for host in self._hosts.values():
+                for conn, returned in host['idle']:
+                    conn.close()
+                host['idle'] = []
+
+
+#: methods that may be sent again if a reused connection turns out to have
+#: been closed by the server; other methods always get a new connection, since
+#: the server may have acted on them before closing it (app PUTs and POSTs
+#: add history entries on the host)
+RESENDABLE_METHODS = ('GET', 'HEAD')
+
+#: errors from a reused connection that mean the server closed it (not a
+#: timeout); while reading the response, only RemoteDisconnected, which means
+#: that no response bytes were read at all, leads to a resend
+STALE_CONNECTION_ERRORS = (RemoteDisconnected, ConnectionResetError,
+                           BrokenPipeError)
+
+#: the pool used by keep_alive requests
+connection_pool = ConnectionPool()
+
 
-class UrlRequest(Thread):
+def get_pool_stats():
+    '''Return the number of pooled connections made ('new') and reused, the
+    number of reused connections that had gone stale and were replaced, and
+    the number of new https connections that resumed an earlier TLS session.
+    '''
+    with connection_pool._lock:
+        return dict(connection_pool.stats)
+
+
+if HTTPSConnection is not None:
+    class PooledHTTPSConnection(HTTPSConnection):
+        '''HTTPSConnection that resumes the TLS session of its pool host.'''
+
+        pool_host = None
+
+        def connect(self):
+            HTTPConnection.connect(self)
+            server_hostname = self._tunnel_host or self.host
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname,
+                session=self.pool_host['session'])
+            if self.sock.session_reused:
+                with connection_pool._lock:
+                    connection_pool.stats['tls_resumed'] += 1
+
+
+class UrlRequest(object):
     '''A UrlRequest. See module documentation for usage.
 
     .. versionchanged:: 1.5.1
@@ -122,6 +376,10 @@ class UrlRequest(Thread):
 
         Parameters `on_cancel` added.
 
+    Parameters `keep_alive`, `priority` and `block` added in this copy;
+    requests run on
+    :data:`request_executor` instead of each being a Thread.
+
     :Parameters:
         `url`: str
             Complete url string to call.
@@ -155,6 +413,8 @@ class UrlRequest(Thread):
             or don't use ``on_progress``.
         `timeout`: int, defaults to None
             If set, blocking operations will timeout after this many seconds.
+            The connection's socket times out after this many seconds, or
+            after :data:`URLREQUEST_TIMEOUT` if not set.
         `method`: str, defaults to 'GET' (or 'POST' if ``body`` is specified)
             The HTTP method to use.
         `decode`: bool, defaults to True
@@ -178,6 +438,18 @@ class UrlRequest(Thread):
         `proxy_headers`: dict, defaults to None
             If set, and `proxy_host` is also set, the headers to send to the
             proxy server in the ``CONNECT`` request.
+        `keep_alive`: bool, defaults to False
+            If True, use a persistent connection from :data:`connection_pool`
+            (not used with a proxy). If a reused connection turns out to have
+            been closed by the server before any of the response was read, a
+            GET or HEAD is sent again on a new one; other methods always get a
+            new connection.
+        `priority`: int, defaults to LANE_USER
+            The lane of the request; while requests are waiting for a worker,
+            those with a lower priority number start first.
+        `block`: bool, defaults to None
+            If True, wait for the result before returning (see :meth:`wait`);
+            by default, only requests with a `timeout` wait.
     '''
 
     def __init__(self, url, on_success=None, on_redirect=None,
@@ -186,11 +458,11 @@ class UrlRequest(Thread):
                  timeout=None, method=None, decode=True, debug=False,
                  file_path=None, ca_file=None, verify=True, proxy_host=None,
                  proxy_port=None, proxy_headers=None, user_agent=None,
-                 on_cancel=None):
+                 on_cancel=None, keep_alive=False, priority=LANE_USER,
+                 block=None):
         super(UrlRequest, self).__init__()
         self._queue = deque()
         self._trigger_result = Clock.create_trigger(self._dispatch_result, 0)
-        self.daemon = True
         self.on_success = WeakMethod(on_success) if on_success else None
         self.on_redirect = WeakMethod(on_redirect) if on_redirect else None
         self.on_failure = WeakMethod(on_failure) if on_failure else None
@@ -208,12 +480,16 @@ class UrlRequest(Thread):
         self._resp_length = -1
         self._chunk_size = chunk_size
         self._timeout = timeout
+        self._socket_timeout = (URLREQUEST_TIMEOUT if timeout is None
+                                else timeout)
         self._method = method
         self.ca_file = ca_file
         self.verify = verify
         self._proxy_host = proxy_host
         self._proxy_port = proxy_port
         self._proxy_headers = proxy_headers
+        self._keep_alive = keep_alive
+        self.priority = priority
         self._cancel_event = Event()
 
         #: Url of the request
@@ -225,14 +501,20 @@ class UrlRequest(Thread):
         #: Request headers passed in __init__
         self.req_headers = req_headers
 
-        # save our request to prevent GC
+        # save our request to prevent GC; it is removed once the result has
+        #  been dispatched
         g_requests.append(self)
 
-        self.start()
+        try:
+            request_executor.submit(self)
+        except Full:
+            self._queue.appendleft(('error', None, Exception(
+                'UrlRequest: too many requests waiting; not sent')))
+            Clock.schedule_once(self._dispatch_result, 0)
         
-        # if timeout is specified, make it synchronous;
+        # if timeout is specified, make it synchronous unless block=False;
         #  the alternative is for the user's code to call wait()
-        if timeout is not None:
+        if block or (block is None and timeout is not None):
             self.wait()
 
     def run(self):
@@ -259,17 +541,9 @@ class UrlRequest(Thread):
             else:
                 q(('killed', None, None))
 
-        # using trigger can result in a missed on_success event
-        self._trigger_result()
-
-        # clean ourself when the queue is empty
-        while len(self._queue):
-            sleep(.1)
-            self._trigger_result()
-
-        # ok, authorize the GC to clean us.
-        if self in g_requests:
-            g_requests.remove(self)
+        # a trigger that is already pending for a progress report could
+        #  miss this result, so schedule a dispatch of its own
+        Clock.schedule_once(self._dispatch_result, 0)
 
     def _parse_url(self, url):
         parse = urlparse(url)
@@ -292,11 +566,7 @@ class UrlRequest(Thread):
 
     def _fetch_url(self, url, body, headers, q):
         # Parse and fetch the current url
-        trigger = self._trigger_result
-        chunk_size = self._chunk_size
-        report_progress = self.on_progress is not None
-        timeout = self._timeout
-        file_path = self.file_path
+        timeout = self._socket_timeout
         ca_file = self.ca_file
         verify = self.verify
 
@@ -345,26 +615,103 @@ class UrlRequest(Thread):
             ctx.verify_mode = ssl.CERT_NONE
             args['context'] = ctx
 
-        if self._proxy_host:
-            Logger.debug('UrlRequest: {0} - proxy via {1}:{2}'.format(
-                id(self), self._proxy_host, self._proxy_port
-            ))
-            req = cls(self._proxy_host, self._proxy_port, **args)
-            if parse.scheme == 'https':
-                req.set_tunnel(host, port, self._proxy_headers)
-            else:
-                path = urlunparse(parse)
-        else:
-            req = cls(host, port, **args)
-
         # send request
         method = self._method
         if method is None:
             method = 'GET' if body is None else 'POST'
-        req.request(method, path, body, headers or {})
 
-        # read header
-        resp = req.getresponse()
+        pool_key = None
+        if self._keep_alive and not self._proxy_host:
+            pool_key = (parse.scheme, host, port, ca_file, verify)
+            req, resp = self._pooled_request(
+                pool_key, cls, host, port, args, method, path, body,
+                headers or {})
+        else:
+            if self._proxy_host:
+                Logger.debug('UrlRequest: {0} - proxy via {1}:{2}'.format(
+                    id(self), self._proxy_host, self._proxy_port
+                ))
+                req = cls(self._proxy_host, self._proxy_port, **args)
+                if parse.scheme == 'https':
+                    req.set_tunnel(host, port, self._proxy_headers)
+                else:
+                    path = urlunparse(parse)
+            else:
+                req = cls(host, port, **args)
+
+            req.request(method, path, body, headers or {})
+
+            # read header
+            resp = req.getresponse()
+
+        try:
+            result = self._read_response(resp, q)
+        except:
+            if pool_key:
+                connection_pool.put(pool_key, req, False)
+            raise
+        if pool_key:
+            # reuse the connection only if the whole response has been read
+            connection_pool.put(pool_key, req, resp.isclosed() and
+                                not resp.will_close and
+                                not self._cancel_event.is_set())
+        else:
+            req.close()
+
+        # return everything
+        return result, resp
+
+    def _pooled_request(self, pool_key, cls, host, port, args, method, path,
+                        body, headers):
+        def factory(pool_host):
+            if cls is HTTPSConnection:
+                # all of the host's connections share one ssl context, which
+                #  is needed for TLS session resumption
+                if pool_host['context'] is None:
+                    pool_host['context'] = (args.get('context') or
+                                            ssl.create_default_context())
+                conn_args = dict(args, context=pool_host['context'])
+                conn = PooledHTTPSConnection(host, port, **conn_args)
+                conn.pool_host = pool_host
+                return conn
+            return cls(host, port, **args)
+
+        # a request that is not safe to send twice goes on a new connection,
+        #  so that it is never resent
+        req, reused = connection_pool.get(
+            pool_key, factory, fresh=method.upper() not in RESENDABLE_METHODS)
+        try:
+            req.timeout = self._socket_timeout
+            if req.sock is not None:
+                req.sock.settimeout(self._socket_timeout)
+            sent = False
+            try:
+                req.request(method, path, body, headers)
+                sent = True
+                resp = req.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                if not reused or (sent and
+                                  not isinstance(e, RemoteDisconnected)):
+                    raise
+                # the server had closed the idle connection, and answered
+                #  nothing; send the request again on a new connection.  Not
+                #  on a timeout: the server may still be working on it
+                if self._debug:
+                    Logger.debug('UrlRequest: {0} - stale pooled connection; '
+                                 'retrying'.format(id(self)))
+                req = connection_pool.replace(pool_key, req, factory)
+                req.request(method, path, body, headers)
+                resp = req.getresponse()
+        except:
+            connection_pool.put(pool_key, req, False)
+            raise
+        return req, resp
+
+    def _read_response(self, resp, q):
+        trigger = self._trigger_result
+        chunk_size = self._chunk_size
+        report_progress = self.on_progress is not None
+        file_path = self.file_path
 
         # read content
         if report_progress or file_path is not None:
@@ -419,10 +766,7 @@ class UrlRequest(Thread):
             except UnicodeDecodeError:
                 # if it's an image? decoding would not work
                 pass
-        req.close()
-
-        # return everything
-        return result, resp
+        return result
 
     def get_connection_for_scheme(self, scheme):
         '''Return the Connection class for a particular scheme.
@@ -554,6 +898,11 @@ class UrlRequest(Thread):
             else:
                 assert(0)
 
+            if result != 'progress':
+                # ok, authorize the GC to clean us.
+                if self in g_requests:
+                    g_requests.remove(self)
+
     @property
     def is_finished(self):
         '''Return True if the request has finished, whether it's a